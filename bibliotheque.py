@@ -5,6 +5,7 @@ import pandas as pd
 import numpy as np
 from scipy import stats
 import scipy
+from pathlib import Path
 from configuration import base_folder, data_path
 from params import *
 
@@ -114,6 +115,345 @@ def define_morlet_family(freqs, cycles , srate, return_time = False):
     else:
         return mw_family
 
+def morlet_tf(sigs, srate, freqs, cycles, decimate_factor = 1, amplitude_exponent = None, dtype = 'complex128'):
+    """
+    Time frequency map with complex morlet wavelets (same wavelets than define_morlet_family) computed in frequency domain :
+    the signal is FFTed once and multiplied by the analytic fourier transform of each wavelet. 
+    For each frequency, only the band of +/- srate / decimate_factor / 2 around the wavelet frequency is inverse FFTed, 
+    which directly gives the decimated samples (no full rate map, exact as long as the wavelet spectrum is negligible out of this band).
+    Edges are the same as a linear convolution (zero padding), like fftconvolve(mode = 'same').
+    Compared to the former pipeline (fftconvolve with the even length define_morlet_family wavelets, abs ** 2 at full rate 
+    then signal.decimate), the wavelets are centred (1 sample shift), there is no Chebyshev anti alias filter and the default 
+    of sig_to_tf is single precision : decimated power maps differ by about 1.4 % relative RMS at low frequencies 
+    and up to about 3.6 % at 150 Hz. Agreement with a direct centred convolution is checked by test_morlet_tf.
+    
+    ----------
+    Parameters
+    ----------
+    sigs : np.array
+        Signal(s) with time on last axis (1D or chan * time)
+    srate : float
+        Sampling rate of the signal(s)
+    freqs : np.array
+        Frequency vector of the wavelets
+    cycles : np.array
+        Number of cycles of the wavelets
+    decimate_factor : int
+        Time decimation factor of the output. Default is 1
+    amplitude_exponent : float or None
+        If not None return abs(tf) ** amplitude_exponent (real) instead of the complex map. Default is None
+    dtype : str
+        'complex128' or 'complex64' (computations in single precision, output complex64 or float32). Default is 'complex128'
+    -------
+    Returns
+    -------
+    - np.array
+        Time frequency map with shape sigs.shape[:-1] + (freqs.size, ceil(n_times / decimate_factor))
+    """
+    import scipy.fft
+    dtype = np.dtype(dtype)
+    real_dtype = np.float32 if dtype == np.complex64 else np.float64
+    sigs = np.asarray(sigs, dtype = real_dtype)
+    freqs = np.asarray(freqs, dtype = 'float64')
+    cycles = np.asarray(cycles, dtype = 'float64')
+    q = int(decimate_factor)
+    
+    n_times = sigs.shape[-1]
+    n_out = (n_times + q - 1) // q
+    s = cycles / (2 * np.pi * freqs) # gaussian standard deviations of wavelets in seconds
+    pad = int(np.ceil(8 * s.max() * srate)) # zero padding that avoids circular wrapping (gaussian tail at 8 sd ~ 1e-14)
+    m_size = scipy.fft.next_fast_len(-(-(n_times + pad) // q)) # size of the decimated inverse FFTs
+    l_size = m_size * q # size of the signal FFT, multiple of q
+    
+    spectrum = scipy.fft.rfft(sigs, n = l_size, axis = -1) # FFT of the signal once
+    nu = np.arange(spectrum.shape[-1]) * srate / l_size
+    m = np.arange(n_out)
+    
+    out_dtype = dtype if amplitude_exponent is None else real_dtype
+    tf = np.zeros(sigs.shape[:-1] + (freqs.size, n_out), dtype = out_dtype)
+    for i, (f, si) in enumerate(zip(freqs, s)):
+        k0 = int(round(f * l_size / srate)) # bin of the wavelet frequency
+        k = np.arange(max(k0 - m_size // 2, 0), min(k0 - m_size // 2 + m_size, spectrum.shape[-1])) # band kept around f
+        kernel = srate * si * np.sqrt(2 * np.pi) * np.exp(-2 * np.pi ** 2 * si ** 2 * (nu[k] - f) ** 2) # analytic FT of the wavelet
+        band = np.zeros(sigs.shape[:-1] + (m_size,), dtype = dtype)
+        band[..., (k - k0) % m_size] = spectrum[..., k] * kernel.astype(real_dtype)
+        tf_f = scipy.fft.ifft(band, axis = -1)[..., :n_out] / q # decimated samples of the band shifted to 0 Hz
+        if amplitude_exponent is None:
+            tf[..., i, :] = tf_f * np.exp(2j * np.pi * k0 * m / m_size).astype(dtype) # shift back to f
+        else:
+            tf[..., i, :] = np.abs(tf_f) ** amplitude_exponent
+    return tf
+
+def test_morlet_tf(srate = 1000., duration = 20., n_chans = 3, n_freqs = 8):
+    """
+    Check morlet_tf against a direct centred convolution with the complex morlet wavelets (odd length support, 
+    decimation by subsampling) for 1D and chan * time signals, both dtypes and some decimation factors
+    """
+    import scipy.signal
+    rng = np.random.default_rng(seed = 0)
+    sigs = rng.standard_normal((n_chans, int(duration * srate)))
+    freqs = np.logspace(np.log10(4), np.log10(150), num = n_freqs, base = 10)
+    cycles = np.logspace(np.log10(10), np.log10(30), num = n_freqs, base = 10)
+
+    ref = np.zeros((n_chans, n_freqs, sigs.shape[-1]), dtype = 'complex128')
+    for i, (f, c) in enumerate(zip(freqs, cycles)):
+        half = int(np.ceil(8 * c / (2 * np.pi * f) * srate))
+        tmw = np.arange(-half, half + 1) / srate # odd length, centred on 0
+        mw = complex_mw(tmw, n_cycles = c, freq = f)
+        ref[:, i, :] = scipy.signal.fftconvolve(sigs, mw[None, :], mode = 'same', axes = -1)
+
+    for dtype, rtol in [('complex128', 1e-10), ('complex64', 1e-5)]:
+        for q in [1, 4, 10]:
+            ref_q = ref[..., ::q]
+            tf = morlet_tf(sigs, srate, freqs, cycles, decimate_factor = q, dtype = dtype)
+            assert tf.shape == ref_q.shape and tf.dtype == np.dtype(dtype)
+            err = np.max(np.abs(tf - ref_q)) / np.max(np.abs(ref_q))
+            print(dtype, 'decimate', q, 'max rel err :', err)
+            assert err < rtol
+
+            tf_1d = morlet_tf(sigs[0], srate, freqs, cycles, decimate_factor = q, dtype = dtype)
+            assert tf_1d.shape == ref_q.shape[1:]
+            assert np.max(np.abs(tf_1d - ref_q[0])) / np.max(np.abs(ref_q[0])) < rtol
+
+            power = morlet_tf(sigs, srate, freqs, cycles, decimate_factor = q, amplitude_exponent = 2, dtype = dtype)
+            power_ref = np.abs(ref_q) ** 2
+            assert np.max(np.abs(power - power_ref)) / np.max(power_ref) < rtol
+
+def deform_operator(times, cycle_times, points_per_cycle, segment_ratios = None):
+    """
+    Sparse linear operator of the cyclical deformation of traces to a cycle template, 
+    same result than physio.deform_traces_to_cycle_template (linear interpolation) but built once 
+    for given times and cycle times and then applied to any data with apply_deform_operator.
+    Each deformed point is a weighted sum of 2 samples, the operator is stored as its non zero (row, col, weight).
+    
+    ----------
+    Parameters
+    ----------
+    times : np.array
+        Timestamps of the traces
+    cycle_times : np.array
+        Cycle times with shape (n_cycles, n_segments + 1) (ex : inspi_time, expi_time, next_inspi_time)
+    points_per_cycle : int
+        Number of phase points per cycle
+    segment_ratios : None or float or list
+        Ratios of segments in the cycle template (None if one segment)
+    -------
+    Returns
+    -------
+    - xr.Dataset
+        weight, row and col along a nnz dim + times of the traces
+    """
+    n_seg = cycle_times.shape[1] - 1
+    if n_seg == 1:
+        ratios = np.array([0., 1.])
+    else:
+        if np.isscalar(segment_ratios):
+            segment_ratios = [segment_ratios]
+        ratios = np.array([0.] + list(segment_ratios) + [1.])
+    
+    assert (cycle_times[1:, 0] == cycle_times[:-1, -1]).all(), 'Start and end cycle times do not match'
+    assert cycle_times[0, 0] >= times[0] and cycle_times[-1, -1] <= times[-1]
+    
+    # times to cycles : c + ratio of segment start + relative position in the segment
+    keep_inds, = np.nonzero((times >= cycle_times[0, 0]) & (times < cycle_times[-1, -1]))
+    clipped_times = times[keep_inds]
+    seg_starts = cycle_times[:, :-1].ravel()
+    seg_stops = cycle_times[:, 1:].ravel()
+    seg = np.searchsorted(seg_starts, clipped_times, side = 'right') - 1
+    c, s = np.divmod(seg, n_seg)
+    times_to_cycles = (clipped_times - seg_starts[seg]) / (seg_stops[seg] - seg_starts[seg]) * (ratios[s + 1] - ratios[s]) + c + ratios[s]
+    
+    # linear interpolation (with extrapolation at edges) at cycle points
+    cycle_points = np.arange(0, cycle_times.shape[0], 1. / points_per_cycle)
+    hi = np.searchsorted(times_to_cycles, cycle_points).clip(1, times_to_cycles.size - 1)
+    lo = hi - 1
+    w = (cycle_points - times_to_cycles[lo]) / (times_to_cycles[hi] - times_to_cycles[lo])
+    
+    rows = np.arange(cycle_points.size)
+    ds = xr.Dataset()
+    ds['row'] = xr.DataArray(np.concatenate([rows, rows]), dims = ['nnz'])
+    ds['col'] = xr.DataArray(np.concatenate([keep_inds[lo], keep_inds[hi]]), dims = ['nnz'])
+    ds['weight'] = xr.DataArray(np.concatenate([1 - w, w]), dims = ['nnz'])
+    ds['times'] = xr.DataArray(times, dims = ['time'])
+    ds.attrs['n_cycles'] = cycle_times.shape[0]
+    ds.attrs['points_per_cycle'] = points_per_cycle
+    return ds
+
+def apply_deform_operator(operator, data, times = None):
+    """
+    Apply a deformation operator (see deform_operator) to data in one sparse matrix product
+    
+    ----------
+    Parameters
+    ----------
+    operator : xr.Dataset
+        Output of deform_operator
+    data : np.array
+        Traces with time on 0 axis, any shape after (n_times * n_features ...)
+    times : np.array or None
+        Timestamps of data, checked against the ones of the operator if not None
+    -------
+    Returns
+    -------
+    - np.array
+        Deformed data stacked by cycles : shape (n_cycles, points_per_cycle) + data.shape[1:]
+    """
+    import scipy.sparse
+    n_times = operator['times'].size
+    assert data.shape[0] == n_times, f'data has {data.shape[0]} times and operator {n_times}'
+    if times is not None:
+        assert np.allclose(times, operator['times'].values), 'times of data do not match times of operator'
+    n_cycles, points_per_cycle = operator.attrs['n_cycles'], operator.attrs['points_per_cycle']
+    matrix = scipy.sparse.csr_matrix((operator['weight'].values, (operator['row'].values, operator['col'].values)),
+                                     shape = (n_cycles * points_per_cycle, n_times))
+    deformed = matrix @ data.reshape(n_times, -1)
+    return deformed.reshape((n_cycles, points_per_cycle) + data.shape[1:])
+
+def events_to_cycle_phase(event_times, cycle_starts, cycle_stops):
+    """
+    Assign events (ex : ECG R peaks, SCR onsets) to the cycle (ex : respiratory cycle) they fall in 
+    and compute their phase = relative position in the cycle, with one searchsorted (cycles sorted and not overlapping)
+    
+    ----------
+    Parameters
+    ----------
+    event_times : np.array
+        Times of events
+    cycle_starts : np.array
+        Start times of cycles (ex : inspi_time), sorted
+    cycle_stops : np.array
+        Stop times of cycles (ex : next_inspi_time), excluded
+    -------
+    Returns
+    -------
+    - cycle_inds : np.array
+        Index of the cycle of each event (-1 if the event is out of any cycle)
+    - phases : np.array
+        Phase between 0 and 1 of each event in its cycle (nan if the event is out of any cycle)
+    """
+    event_times = np.asarray(event_times, dtype = 'float64')
+    cycle_starts = np.asarray(cycle_starts, dtype = 'float64')
+    cycle_stops = np.asarray(cycle_stops, dtype = 'float64')
+    
+    cycle_inds = np.searchsorted(cycle_starts, event_times, side = 'right') - 1 # last cycle starting before (or at) the event
+    inside = cycle_inds >= 0
+    inside[inside] = event_times[inside] < cycle_stops[cycle_inds[inside]] # and ending after the event
+    cycle_inds[~inside] = -1
+    
+    phases = np.full(event_times.size, np.nan)
+    c = cycle_inds[inside]
+    phases[inside] = (event_times[inside] - cycle_starts[c]) / (cycle_stops[c] - cycle_starts[c])
+    return cycle_inds, phases
+
+def epoch_signal(data, srate, event_times, start_offset, n_points):
+    """
+    Cut epochs of a signal around events in one vectorized gathering (no copy of the signal, only the epochs are copied).
+    Epochs starting before the beginning or ending after the end of the signal are dropped.
+    
+    ----------
+    Parameters
+    ----------
+    data : np.array
+        Signal with time on last axis (1D, 2D chan * time, 3D chan * freq * time ...)
+    srate : float
+        Sampling rate of data
+    event_times : np.array
+        Times of the events in seconds
+    start_offset : float
+        Start of epochs relative to events in seconds (ex : -5 for a window starting 5 seconds before events)
+    n_points : int
+        Number of points of epochs
+    -------
+    Returns
+    -------
+    - epochs : np.array
+        Shape (n_kept_events,) + data.shape[:-1] + (n_points,)
+    - keep : np.array
+        Boolean mask of kept events (False = dropped events)
+    """
+    event_times = np.asarray(event_times, dtype = 'float64')
+    n_times = data.shape[-1]
+    start_times = event_times + start_offset
+    start_inds = np.floor(start_times * srate).astype('int64')
+    keep = (start_times >= 0) & (start_inds + n_points <= n_times)
+    
+    windows = np.lib.stride_tricks.sliding_window_view(data, n_points, axis = -1) # view ... * start * n_points
+    epochs = windows[..., start_inds[keep], :] # ... * event * n_points
+    epochs = np.moveaxis(epochs, -2, 0) # event * ... * n_points
+    return epochs, keep
+
+def welch_segments_fft(data, nperseg, nfft):
+    """
+    One sided FFT of the Welch segments of a signal (hann window, 50 % overlap, constant detrend as scipy.signal.welch),
+    computed in one call along the last axis
+
+    ----------
+    Parameters
+    ----------
+    data : np.array
+        Signal with time on last axis (1D or 2D chan * time)
+    nperseg : int
+        Number of points of the segments
+    nfft : int
+        Size of the FFT (zero padding if > nperseg)
+    -------
+    Returns
+    -------
+    - segments_fft : np.array
+        Shape data.shape[:-1] + (n_segments, nfft // 2 + 1)
+    """
+    from scipy import signal
+    import scipy.fft
+
+    step = nperseg - nperseg // 2
+    segments = np.lib.stride_tricks.sliding_window_view(data, nperseg, axis = -1)[..., ::step, :] # view ... * segment * nperseg
+    window = signal.get_window('hann', nperseg)
+    segments = (segments - segments.mean(axis = -1, keepdims = True)) * window # detrend and taper (copy)
+    return scipy.fft.rfft(segments, n = nfft, axis = -1)
+
+def multichan_coherence(sigs, ref_sig, srate, lowest_freq, n_cycles = 5, nfft_factor = 1):
+    """
+    Magnitude squared coherence between each chan of sigs and a reference signal.
+    Segments of the reference signal are FFTed once and all the chans in one call,
+    then cross spectra of all the chans are computed in one vectorized step
+
+    ----------
+    Parameters
+    ----------
+    sigs : np.array
+        Signals, shape chan * time
+    ref_sig : np.array
+        Reference signal (ex : resp), shape time
+    srate : float
+        Sampling rate
+    lowest_freq : float
+        Lowest frequency interpretable : windows contain n_cycles cycles of this frequency
+    n_cycles : int
+        Number of cycles of lowest_freq in each window
+    nfft_factor : int
+        Zero padding = window length * nfft_factor
+    -------
+    Returns
+    -------
+    - f : np.array
+        Frequency vector
+    - Cxy : np.array
+        Coherence, shape chan * freq
+    """
+    nperseg = int(n_cycles * srate / lowest_freq)
+    nfft = int(nperseg * nfft_factor)
+
+    ref_fft = welch_segments_fft(ref_sig, nperseg, nfft) # segment * freq, once
+    sigs_fft = welch_segments_fft(sigs, nperseg, nfft) # chan * segment * freq
+
+    Pyy = np.mean(np.abs(ref_fft) ** 2, axis = 0) # scaling factors of the spectra cancel in the coherence
+    Pxx = np.mean(np.abs(sigs_fft) ** 2, axis = 1)
+    Pxy = np.mean(np.conj(sigs_fft) * ref_fft[None, :, :], axis = 1)
+
+    f = np.fft.rfftfreq(nfft, 1 / srate)
+    Cxy = np.abs(Pxy) ** 2 / Pxx / Pyy[None, :]
+    return f, Cxy
+
 def df_baseline(df, indexes, metrics, mode = 'ratio'):
     """
     Normalize dataframe data according to baseline
@@ -276,6 +616,93 @@ def preproc_bio(sig, sig_type, srate, bio_filters):
     order = bio_filters[sig_type]['order']
     return gh.iirfilt(sig=sig, srate=srate, lowcut=low, highcut=high, ftype=ftype, order=order)
 
+def chunked_detrend(data, chunk_size):
+    """
+    Linear detrend along time axis (last axis), in place and chunk by chunk
+    to avoid full size temporary arrays (same output than scipy.signal.detrend)
+    
+    ----------
+    Parameters
+    ----------
+    - data : np.array
+        1D or 2D (chan * time) float array, modified in place
+    - chunk_size : int
+        Number of time points processed at once
+
+    -------
+    Returns
+    -------
+    - np.array : data detrended (same object)
+    """  
+    n = data.shape[-1]
+    # least square fit of a + b * t with t centered to have decoupled estimators
+    t_mean = (n - 1) / 2.
+    t_var = np.sum((np.arange(n) - t_mean) ** 2)
+    sum_x = np.zeros(data.shape[:-1])
+    sum_tx = np.zeros(data.shape[:-1])
+    for start in range(0, n, chunk_size):
+        chunk = data[..., start:start + chunk_size]
+        t = np.arange(start, start + chunk.shape[-1]) - t_mean
+        sum_x += chunk.sum(axis=-1)
+        sum_tx += chunk @ t
+    intercept = sum_x / n
+    slope = sum_tx / t_var
+    for start in range(0, n, chunk_size):
+        chunk = data[..., start:start + chunk_size]
+        t = np.arange(start, start + chunk.shape[-1]) - t_mean
+        chunk -= intercept[..., None] + slope[..., None] * t
+    return data
+
+def chunked_sosfiltfilt(sos, data, chunk_size):
+    """
+    Zero phase IIR filtering along time axis (last axis), in place and chunk by chunk by carrying
+    the filter state between chunks (same output than scipy.signal.sosfiltfilt with default odd padding)
+    
+    ----------
+    Parameters
+    ----------
+    - sos : np.array
+        Second order sections of the filter
+    - data : np.array
+        1D or 2D (chan * time) float array, modified in place
+    - chunk_size : int
+        Number of time points processed at once
+
+    -------
+    Returns
+    -------
+    - np.array : data filtered (same object)
+    """  
+    from scipy import signal
+    n = data.shape[-1]
+    n_sections = sos.shape[0]
+    ntaps = 2 * n_sections + 1
+    ntaps -= min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    edge = min(3 * ntaps, n - 1)
+
+    # odd extensions at both edges, computed before data is overwritten
+    left_ext = 2 * data[..., :1] - data[..., edge:0:-1]
+    right_ext = 2 * data[..., -1:] - data[..., -2:-(edge + 2):-1]
+
+    zi = signal.sosfilt_zi(sos) # (n_sections, 2)
+    zi = zi.reshape((n_sections,) + (1,) * (data.ndim - 1) + (2,))
+    
+    # forward
+    y, z = signal.sosfilt(sos, left_ext, axis=-1, zi=zi * left_ext[..., :1])
+    for start in range(0, n, chunk_size):
+        chunk = data[..., start:start + chunk_size]
+        chunk[:], z = signal.sosfilt(sos, chunk, axis=-1, zi=z)
+    right_y, z = signal.sosfilt(sos, right_ext, axis=-1, zi=z)
+
+    # backward
+    right_y = right_y[..., ::-1]
+    y, z = signal.sosfilt(sos, right_y, axis=-1, zi=zi * right_y[..., :1])
+    for stop in range(n, 0, -chunk_size):
+        chunk = data[..., max(stop - chunk_size, 0):stop]
+        filtered, z = signal.sosfilt(sos, chunk[..., ::-1], axis=-1, zi=z)
+        chunk[:] = filtered[..., ::-1]
+    return data
+
 def mne_to_xarray(raw):
     """
     Convert raw mne object to xarray
@@ -296,6 +723,53 @@ def mne_to_xarray(raw):
     da = xr.DataArray(data=data, dims = ['chan','time'], coords = {'chan':raw.info['ch_names'], 'time':gh.time_vector(data[0,:], srate)}, attrs={'srate':srate})
     return da
 
+def ica_to_xarray(ica):
+    """
+    Serialize a fitted mne ICA object to xarray (bytes of its fif file) so that it can be cached by jobtools
+    
+    ----------
+    Parameters
+    ----------
+    - ica : mne.preprocessing.ICA
+        Fitted ICA
+        
+    -------
+    Returns
+    -------
+    - xr.Dataset 
+    """  
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = Path(tmp_dir) / 'decomposition-ica.fif'
+        ica.save(fname, verbose = 'CRITICAL')
+        buffer = np.frombuffer(fname.read_bytes(), dtype = 'uint8')
+    ds = xr.Dataset()
+    ds['ica_fif'] = xr.DataArray(data = buffer, dims = ['byte'], attrs = {'n_components':int(ica.n_components_), 'method':ica.method})
+    return ds
+
+def xarray_to_ica(ds):
+    """
+    Rebuild a fitted mne ICA object from its xarray serialization (see ica_to_xarray)
+    
+    ----------
+    Parameters
+    ----------
+    - ds : xr.Dataset
+        Dataset with a ica_fif variable
+        
+    -------
+    Returns
+    -------
+    - mne.preprocessing.ICA 
+    """  
+    import mne
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = Path(tmp_dir) / 'decomposition-ica.fif'
+        fname.write_bytes(ds['ica_fif'].values.astype('uint8').tobytes())
+        ica = mne.preprocessing.read_ica(fname, verbose = 'CRITICAL')
+    return ica
+
 def get_triggs(raw, blocs, code_trigg):
     """
     Load timestamps of triggers from mne.raw object
@@ -686,4 +1160,8 @@ def compute_spectrum_log_slope(spectrum, freqs, freq_range = [1,40], show = Fals
         ax.semilogy(freqs[mask],  fit)
         plt.show()
     
-    return a
\ No newline at end of file
+    return a
+
+
+if __name__ == '__main__':
+    test_morlet_tf()
@@ -49,26 +49,21 @@ def compute_rms(x):
     -------
     Returns
     -------
-    - np.array
-        Same size than input but Root Mean Squared
+    - float
+        Root Mean Square of the signal
     """
-
-    n = x.size
-    ms = 0
-    for i in range(n):
-        ms += x[i] ** 2
-    ms /= n
-    return np.sqrt(ms)
+    return np.sqrt(np.mean(x ** 2))
 
 def sliding_rms(x, sf, window=0.5, step=0.2, interp=True):
     """
     Compute a sliding root mean square 
+    Window sums of squares are computed with a cumulative sum so that all windows (and all channels) are computed in one pass
 
     ----------
     Parameters
     ----------
     - x : np.array
-        Signal
+        Signal, 1D (time) or 2D (chan * time)
     - sf : float
         Sampling frequency
     - window : float
@@ -84,15 +79,14 @@ def sliding_rms(x, sf, window=0.5, step=0.2, interp=True):
     - t : np.array
         Time vector of the returned trace
     - out : np.array
-        Signal (trace) smoothed by RMS
+        Signal (trace) smoothed by RMS, same number of dims than x (time on last axis)
     """
 
     halfdur = window / 2
-    n = x.size
+    n = x.shape[-1]
     total_dur = n / sf
     last = n - 1
     idx = np.arange(0, total_dur, step)
-    out = np.zeros(idx.size)
 
     # Define beginning, end and time (centered) vector
     beg = ((idx - halfdur) * sf).astype(int)
@@ -104,15 +98,15 @@ def sliding_rms(x, sf, window=0.5, step=0.2, interp=True):
     # beg, end = beg[mask], end[mask]
     t = np.column_stack((beg, end)).mean(1) / sf
 
-
-
-    # Now loop over successive epochs
-    for i in range(idx.size):
-        out[i] = compute_rms(x[beg[i] : end[i]])
+    # Sum of squares of all epochs x[beg:end] from the cumulative sum of squares
+    x = np.asarray(x, dtype='float64')
+    cumsum = np.zeros(x.shape[:-1] + (n + 1,), dtype='float64')
+    np.cumsum(x ** 2, axis=-1, out=cumsum[..., 1:])
+    out = np.sqrt((cumsum[..., end] - cumsum[..., beg]) / (end - beg))
 
     # Finally interpolate
     if interp and step != 1 / sf:
-        f = interpolate.interp1d(t, out, kind="cubic", bounds_error=False, fill_value=0, assume_sorted=True)
+        f = interpolate.interp1d(t, out, kind="cubic", bounds_error=False, fill_value=0, assume_sorted=True, axis=-1)
         t = np.arange(n) / sf
         out = f(t)
 
@@ -142,6 +136,69 @@ def compute_artifact_features(inds, srate):
     return artifacts
 
 
+def merge_intervals(starts, stops):
+    """
+    Union of half-open intervals [start, stop) as sorted disjoint intervals (sweep over intervals sorted by start)
+
+    ----------
+    Parameters
+    ----------
+    - starts : np.array
+        Starts of intervals (indices or times)
+    - stops : np.array
+        Stops of intervals (excluded)
+
+    -------
+    Returns
+    -------
+    - merged_starts, merged_stops : np.array
+        Sorted starts and stops of disjoint intervals covering the same points, empty intervals are removed
+    """
+    starts = np.asarray(starts)
+    stops = np.asarray(stops)
+    keep = stops > starts # remove empty intervals
+    starts, stops = starts[keep], stops[keep]
+    if starts.size == 0:
+        return starts, stops
+    order = np.argsort(starts, kind = 'stable')
+    starts, stops = starts[order], stops[order]
+    running_stops = np.maximum.accumulate(stops) # furthest stop reached so far
+    new_group = np.ones(starts.size, dtype = bool)
+    new_group[1:] = starts[1:] > running_stops[:-1] # a new interval starts after all the previous ones
+    group_first, = np.nonzero(new_group)
+    group_last = np.append(group_first[1:] - 1, starts.size - 1)
+    return starts[group_first], running_stops[group_last]
+
+def overlap_intervals(starts, stops, other_starts, other_stops):
+    """
+    Find which half-open intervals [start, stop) overlap at least one of other intervals, in O((n+m) log m) with searchsorted
+    (ex : which respiratory cycles overlap an artifact)
+
+    ----------
+    Parameters
+    ----------
+    - starts, stops : np.array
+        Intervals to test
+    - other_starts, other_stops : np.array
+        Intervals to test against (can overlap themselves, unsorted)
+
+    -------
+    Returns
+    -------
+    - np.array
+        Boolean mask of size starts.size, True when the interval overlaps any other interval
+    """
+    starts = np.asarray(starts)
+    stops = np.asarray(stops)
+    merged_starts, merged_stops = merge_intervals(other_starts, other_stops)
+    ind = np.searchsorted(merged_stops, starts, side = 'right') # first merged interval ending after the start
+    overlap = np.zeros(starts.size, dtype = bool)
+    valid = ind < merged_stops.size
+    overlap[valid] = merged_starts[ind[valid]] < stops[valid] # and starting before the stop
+    overlap &= stops > starts # empty intervals overlap nothing
+    return overlap
+
+
 def detect_artifacts(sig, srate, n_deviations = 5, low_freq = 40 , high_freq = 150, wsize = 1, step = 0.2):
     """
     Detect artifacts based on burst of low_freq to high_freq power deduced from filtering + sliding RMS of the filtered signal
@@ -265,3 +322,53 @@ def insert_noise(sig, srate, chan_artifacts, freq_min=30., margin_s=0.2, seed=No
     return sig_corrected
 
 
+
+def bench_sliding_rms(n_chans=30, duration=600., srate=1000., window=1.5, step=0.5):
+    """
+    Benchmark of sliding_rms on a synthetic multi channel recording against the previous
+    implementation (loop over windows with a per sample python loop)
+    """
+    import time
+
+    def compute_rms_loop(x):
+        n = x.size
+        ms = 0
+        for i in range(n):
+            ms += x[i] ** 2
+        ms /= n
+        return np.sqrt(ms)
+
+    def sliding_rms_loop(x, sf, window, step):
+        halfdur = window / 2
+        n = x.size
+        idx = np.arange(0, n / sf, step)
+        beg = ((idx - halfdur) * sf).astype(int)
+        end = ((idx + halfdur) * sf).astype(int)
+        beg[beg < 0] = 0
+        end[end > n - 1] = n - 1
+        t = np.column_stack((beg, end)).mean(1) / sf
+        out = np.zeros(idx.size)
+        for i in range(idx.size):
+            out[i] = compute_rms_loop(x[beg[i] : end[i]])
+        f = interpolate.interp1d(t, out, kind="cubic", bounds_error=False, fill_value=0, assume_sorted=True)
+        return f(np.arange(n) / sf)
+
+    rng = np.random.default_rng(seed=0)
+    sigs = rng.standard_normal((n_chans, int(duration * srate)))
+
+    t0 = time.perf_counter()
+    _, rms_vectorized = sliding_rms(sigs, sf=srate, window=window, step=step)
+    t1 = time.perf_counter()
+    rms_loop = np.array([sliding_rms_loop(sig, srate, window, step) for sig in sigs])
+    t2 = time.perf_counter()
+
+    print(f'{n_chans} chans * {duration} s at {srate} Hz')
+    print(f'loop : {t2 - t1:.3f} s')
+    print(f'vectorized : {t1 - t0:.3f} s')
+    print(f'speedup : {(t2 - t1) / (t1 - t0):.1f}')
+    print('max abs diff :', np.max(np.abs(rms_vectorized - rms_loop)))
+    assert np.allclose(rms_vectorized, rms_loop, rtol=1e-10, atol=1e-12)
+
+
+if __name__ == '__main__':
+    bench_sliding_rms()
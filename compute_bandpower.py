@@ -3,9 +3,51 @@ from params import *
 import xarray as xr
 import pandas as pd
 import jobtools
-import ghibtools as gh
+import numpy as np
+import scipy.integrate
 from compute_psd import psd_baselined_job
 
+def band_summaries(psd, freqs, fbands, total_band):
+    """
+    Summarize power spectra in frequency bands for all chans and bands at once.
+    Bands are inclusive frequency masks ([low, high] as label slicing of xarray), integrals come from one cumulative trapezoid
+    
+    ----------
+    Parameters
+    ----------
+    psd : np.array
+        Power spectra, shape chan * freq
+    freqs : np.array
+        Frequency vector (increasing)
+    fbands : dict
+        Band name > [low, high] in Hz
+    total_band : list
+        [low, high] in Hz of the band of total power
+    -------
+    Returns
+    -------
+    - summaries : dict
+        'power_mean', 'power_median', 'power_integral', 'relative_power' > np.array of shape chan * band (bands in the order of fbands).
+        relative_power = power_integral / integral of psd over total_band
+    """
+    bounds = np.array(list(fbands.values()) + [total_band], dtype = 'float64') # band (+ total) * 2
+    masks = (freqs[None, :] >= bounds[:, :1]) & (freqs[None, :] <= bounds[:, 1:]) # band * freq
+    n_bins = masks.sum(axis = 1)
+    
+    cumulative = scipy.integrate.cumulative_trapezoid(psd, freqs, axis = -1, initial = 0) # chan * freq
+    first = np.argmax(masks, axis = 1) # first bin of each band
+    last = masks.shape[1] - 1 - np.argmax(masks[:, ::-1], axis = 1) # last bin of each band
+    integrals = np.where(n_bins > 0, cumulative[:, last] - cumulative[:, first], 0.) # chan * band (+ total)
+    
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = (psd @ masks[:-1].T) / n_bins[:-1] # chan * band
+        relative = integrals[:, :-1] / integrals[:, -1:]
+    medians = np.stack([np.median(psd[:, mask], axis = 1) if mask.any() else np.full(psd.shape[0], np.nan) for mask in masks[:-1]], axis = 1)
+    
+    summaries = {'power_mean':means, 'power_median':medians, 'power_integral':integrals[:, :-1], 'relative_power':relative}
+    return summaries
+
+
 def compute_bandpower(run_key, **p):
     """
     Compute bandpower for each frequency band (EEG)
@@ -13,21 +55,16 @@ def compute_bandpower(run_key, **p):
     participant, session = run_key.split('_')
     psd = psd_baselined_job.get(run_key)['psd_baselined'] # load baselined spectrum
     
-    rows = []
+    chans = psd['chan'].values
+    bands = list(p['fbands'].keys())
+    assert p['total_power'] == 'integral', f"total_power {p['total_power']} not supported"
+    summaries = band_summaries(psd.values, psd['freq'].values, p['fbands'], p['total_band']) # chan * band arrays
     
-    for chan in psd['chan'].values: # loop on chans
-        total_power = psd.loc[chan, p['total_band'][0]:p['total_band'][0]].mean('freq') # compute total mean power
-        for band, bornes in p['fbands'].items(): # loop on frequency bands
-            Psd_chan_band = psd.loc[chan, bornes[0]:bornes[1]] # slice the frequency band
-            power_mean = Psd_chan_band.mean('freq') # mean value
-            power_median = Psd_chan_band.median('freq') # median value
-            power_integral = Psd_chan_band.integrate('freq') # integrate (power)
-            rel_power = power_integral / total_power # relative power by dividing with total power
-
-            row = [participant, session, chan, band, power_mean, power_median, power_integral, rel_power] # store row in a list
-            rows.append(row) # store row in list
-    
-    bandpowers = pd.DataFrame(rows, columns = ['participant','session','chan','band','power_mean','power_median','power_integral','relative_power']) # make dataframe from list of lists
+    bandpowers = pd.DataFrame({'participant':participant, # tidy table, one row by chan * band (chan major)
+                               'session':session,
+                               'chan':np.repeat(chans, len(bands)).astype(str),
+                               'band':np.tile(bands, chans.size).astype(str),
+                               **{metric:values.ravel().astype('float64') for metric, values in summaries.items()}})
     ds_bandpower = xr.Dataset(bandpowers) # dataframe to dataset
     return ds_bandpower
 
@@ -35,15 +72,56 @@ def test_compute_bandpower():
     run_key = 'P02_music'
     ds_bandpower = compute_bandpower(run_key, **bandpower_params)
     print(ds_bandpower)
+
+
+def test_band_summaries_flat():
+    # flat spectrum of 1 : integral = width of the band, relative power = width of the band / width of the total band
+    freqs = np.arange(0, 250.5, 0.5)
+    psd = np.ones((2, freqs.size))
+    fbands = {'delta':[1,4], 'beta':[12,30]}
+    total_band = [1, 200]
+    summaries = band_summaries(psd, freqs, fbands, total_band)
+    assert np.allclose(summaries['power_mean'], 1.)
+    assert np.allclose(summaries['power_median'], 1.)
+    assert np.allclose(summaries['power_integral'], [[3., 18.]] * 2)
+    assert np.allclose(summaries['relative_power'], [[3. / 199., 18. / 199.]] * 2)
+    print('test_band_summaries_flat OK')
+
+
+def test_band_summaries_total_power():
+    # total power is the integral of the spectrum over the whole total_band (not a single bin) :
+    # contiguous bands covering total_band have relative powers summing to 1
+    rng = np.random.default_rng(seed=0)
+    freqs = np.arange(0, 250.25, 0.25)
+    psd = rng.uniform(0.5, 2., size = (3, freqs.size)) / (1 + freqs)
+    fbands = {'low':[1,8], 'mid':[8,45], 'high':[45,200]}
+    total_band = [1, 200]
+    summaries = band_summaries(psd, freqs, fbands, total_band)
+    assert np.allclose(summaries['relative_power'].sum(axis = 1), 1.)
+    
+    # same values as label slicing and trapezoid integration of xarray
+    da = xr.DataArray(psd, dims = ['chan','freq'], coords = {'chan':['a','b','c'], 'freq':freqs})
+    for i, chan in enumerate(da['chan'].values):
+        total_power = da.loc[chan, total_band[0]:total_band[1]].integrate('freq')
+        for j, (band, bornes) in enumerate(fbands.items()):
+            da_band = da.loc[chan, bornes[0]:bornes[1]]
+            assert np.isclose(summaries['power_mean'][i, j], float(da_band.mean('freq')))
+            assert np.isclose(summaries['power_median'][i, j], float(da_band.median('freq')))
+            assert np.isclose(summaries['power_integral'][i, j], float(da_band.integrate('freq')))
+            assert np.isclose(summaries['relative_power'][i, j], float(da_band.integrate('freq') / total_power))
+    print('test_band_summaries_total_power OK')
     
 
-bandpower_job = jobtools.Job(precomputedir, 'bandpower', bandpower_params, compute_bandpower)
+bandpower_job = jobtools.Job(precomputedir, 'bandpower', bandpower_params, compute_bandpower,
+                             depends_on=[(psd_baselined_job, None)])
 jobtools.register_job(bandpower_job)
 
 def compute_all():
     jobtools.compute_job_list(bandpower_job, stim_keys, force_recompute=False, engine='loop')
     
 if __name__ == '__main__':
+    # test_band_summaries_flat()
+    # test_band_summaries_total_power()
     # test_compute_bandpower()
     compute_all()
 
@@ -3,10 +3,9 @@ from params import *
 import xarray as xr
 import pandas as pd
 import jobtools
-import ghibtools as gh
-from bibliotheque import init_nan_da
-from preproc import eeg_interp_artifact_job, convert_vhdr_job
-import physio
+from bibliotheque import multichan_coherence
+from preproc import eeg_interp_artifact_job
+from compute_resp_features import respiration_job
 
 
 def compute_coherence(run_key, **p):
@@ -17,20 +16,10 @@ def compute_coherence(run_key, **p):
     eeg = eeg_interp_artifact_job.get(run_key)['interp'] # load preprocessed eeg
     srate = eeg.attrs['srate']
     
-    resp_raw = convert_vhdr_job.get(run_key)['raw'].sel(chan = p['resp_chan'], time = slice(0, p['session_duration'])).values[:-1] # load raw resp
-    resp_sig, resp_cycles = physio.compute_respiration(resp_raw, srate, parameter_preset='human_airflow') #preproc resp
+    resp_sig = respiration_job.get(run_key)['resp'].values # load preprocessed resp
     
-    da_cxy = None
-    
-    for chan in eeg.coords['chan'].values: # loop over chans
-        sig = eeg.loc[chan,:].values  
-        
-        f, Cxy = gh.coherence(sig, resp_sig, srate, p['lowest_freq_coherence'], nfft_factor = p['nfft_factor'], n_cycles = p['n_cycles']) # compute coherence
-
-        if da_cxy is None:
-            da_cxy = init_nan_da({'chan':eeg.coords['chan'].values, 'freq':f})
-                                  
-        da_cxy.loc[chan, : ] = Cxy # store coherence spectrum in datarray
+    f, Cxy = multichan_coherence(eeg.values, resp_sig, srate, p['lowest_freq_coherence'], nfft_factor = p['nfft_factor'], n_cycles = p['n_cycles']) # compute coherence of all chans at once
+    da_cxy = xr.DataArray(data = Cxy, dims = ['chan','freq'], coords = {'chan':eeg.coords['chan'].values, 'freq':f})
 
     ds_coherence = xr.Dataset()
     ds_coherence['coherence'] = da_cxy # store datarray to dataset
@@ -44,30 +33,20 @@ def coherence_at_resp(run_key, **p):
     """
     participant, session = run_key.split('_')
     
-    coherence_params = p['coherence_params']
-    
     coherence = coherence_job.get(run_key) # load coherence
     coherence = coherence['coherence']
     
-    resp_sig = convert_vhdr_job.get(run_key)['raw'].sel(chan = coherence_params['resp_chan'], time = slice(0, coherence_params['session_duration'])).values[:-1] # load raw resp
-    resp_sig, resp_cycles = physio.compute_respiration(resp_sig, srate, parameter_preset='human_airflow') # preproc resp
+    ds_resp = respiration_job.get(run_key) # load resp spectrum computed on the frequency grid of coherence
+    max_resp = float(ds_resp[f"max_{p['resp_spectrum']}"]) # max power value of resp spectrum < 1 Hz
+    fmax_resp = float(ds_resp[f"fmax_{p['resp_spectrum']}"]) # frequency bin of max power value
+    freq_resp = ds_resp[f"freq_{p['resp_spectrum']}"].values
+    assert freq_resp.shape == coherence['freq'].shape and np.allclose(freq_resp, coherence['freq'].values), 'resp spectrum and coherence must share their frequency grid (same windowing in params.py)'
     
     rows = []
 
-    f_resp, Pxx_resp = gh.spectre(resp_sig, # compute power spectrum of resp signal
-                                  srate, 
-                                  coherence_params['lowest_freq_psd_resp'], 
-                                  nfft_factor = coherence_params['nfft_factor'], 
-                                  n_cycles = coherence_params['n_cycles'])
-
-    Pxx_resp_sel = Pxx_resp[f_resp<1] # zoom on spectrum < 1 Hz
-    max_resp = np.max(Pxx_resp_sel) # compute max power value
-    argmax_resp = np.argmax(Pxx_resp_sel) # get index of max power value
-    fmax_resp = f_resp[argmax_resp] # get frequency bin of max power value
-
     for chan in coherence.coords['chan'].values: # loop over chans
 
-        Cxy_at_resp = coherence.loc[chan, fmax_resp].values # get coherence value at frequency bin of max resp power
+        Cxy_at_resp = coherence.sel(chan = chan).sel(freq = fmax_resp, method = 'nearest').values # get coherence value at frequency bin of max resp power
 
         row = [participant, session, chan, fmax_resp, max_resp,  Cxy_at_resp] 
         rows.append(row)
@@ -90,10 +69,12 @@ def test_compute_coherence_at_resp():
     print(ds_coherence_at_resp.to_dataframe())
     
 
-coherence_job = jobtools.Job(precomputedir, 'coherence', coherence_params, compute_coherence)
+coherence_job = jobtools.Job(precomputedir, 'coherence', coherence_params, compute_coherence,
+                             depends_on=[(eeg_interp_artifact_job, None), (respiration_job, None)])
 jobtools.register_job(coherence_job)
 
-coherence_at_resp_job = jobtools.Job(precomputedir, 'coherence_at_resp', coherence_at_resp_params, coherence_at_resp)
+coherence_at_resp_job = jobtools.Job(precomputedir, 'coherence_at_resp', coherence_at_resp_params, coherence_at_resp,
+                                     depends_on=[(coherence_job, None), (respiration_job, None)])
 jobtools.register_job(coherence_at_resp_job)
 
 
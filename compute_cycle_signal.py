@@ -1,6 +1,6 @@
 from configuration import *
 from params import *
-from bibliotheque import init_nan_da
+from bibliotheque import init_nan_da, apply_deform_operator, epoch_signal
 import ghibtools as gh
 
 import xarray as xr
@@ -11,7 +11,7 @@ import jobtools
 
 from preproc import convert_vhdr_job, eeg_interp_artifact_job
 from compute_rri import rri_signal_job
-from compute_resp_features import respiration_features_job
+from compute_resp_features import respiration_features_job, compute_deform_operator
 
 
 
@@ -44,27 +44,29 @@ def cycle_signal(run_key, **p):
 
     times = eeg.coords['time'].values
 
-    cycle_times = resp_features[['inspi_time','expi_time','next_inspi_time']].values # extract resp cycle times to deform signals
+    deform = cycle_signal_deform_job.get(run_key) # sparse operator of cyclical deformation according to respiratory timestamps
     
-    da_cycle_signals = None 
-    
-    for chan in chans:
+    data = np.zeros((times.size, len(chans)), dtype = eeg.dtype) # time * chan
+    for i, chan in enumerate(chans):
         if chan == 'resp_nose':
-            data = resp_sig.sel(chan='RespiNasale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 mins resp nose signal
+            data[:,i] = resp_sig.sel(chan='RespiNasale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 mins resp nose signal
         elif chan == 'resp_mouth':
-            data = -resp_sig.sel(chan='RespiVentrale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 min and reverse resp belt signal
+            data[:,i] = -resp_sig.sel(chan='RespiVentrale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 min and reverse resp belt signal
         elif chan == 'heart':
-            data = rri.values
+            data[:,i] = rri.values
         else:
-            data = eeg.sel(chan = chan).values
-            
-        # Cyclical deformation of signal
-        cycle_signals = physio.deform_traces_to_cycle_template(data = data, 
-                                                           times = times, 
-                                                           cycle_times = cycle_times,
-                                                           points_per_cycle = p['n_phase_bins'],
-                                                           segment_ratios = p['segment_ratios'],
-                                                           )
+            data[:,i] = eeg.sel(chan = chan).values
+    
+    # Cyclical deformation of all signals at once
+    all_cycle_signals = apply_deform_operator(deform, data, times = times) # cycle * phase * chan
+    
+    mask_cycles = (resp_features['artifact'] == 0) # mask resp cycles without co-occuring EEG artifacting
+    keep_cycles = resp_features[mask_cycles].index # apply mask and select their indices
+    
+    da_cycle_signals = None 
+    
+    for i, chan in enumerate(chans):
+        cycle_signals = all_cycle_signals[:,:,i]
         # if not chan == 'heart':
         #     cycle_signals = np.apply_along_axis(norm , 1 , cycle_signals)
         
@@ -73,11 +75,6 @@ def cycle_signal(run_key, **p):
         elif chan in ['resp_nose','resp_mouth']:
             cycle_signals = np.apply_along_axis(norm , 1 , cycle_signals) # subtract mean and divide by SD along phase axis
         
-
-
-        mask_cycles = (resp_features['artifact'] == 0) # mask resp cycles without co-occuring EEG artifacting
-        keep_cycles = resp_features[mask_cycles].index # apply mask and select their indices
-
         cycle_signal = cycle_signals[keep_cycles,:] # select resp cycles according to mask
 
         m = np.mean(cycle_signal, axis = 0) # compute average deformed signal along cycles axis
@@ -97,7 +94,14 @@ def test_cycle_signal():
     ds = cycle_signal(run_key, **cycle_signal_params)
     print(ds)
     
-cycle_signal_job = jobtools.Job(precomputedir, 'cycle_signal', cycle_signal_params, cycle_signal)
+cycle_signal_deform_job = jobtools.Job(precomputedir, 'cycle_signal_deform', cycle_signal_deform_params, compute_deform_operator,
+                                       depends_on=[(respiration_features_job, None)])
+jobtools.register_job(cycle_signal_deform_job)
+
+cycle_signal_job = jobtools.Job(precomputedir, 'cycle_signal', cycle_signal_params, cycle_signal,
+                                depends_on=[(eeg_interp_artifact_job, None), (rri_signal_job, None),
+                                            (convert_vhdr_job, None), (respiration_features_job, None),
+                                            (cycle_signal_deform_job, None)])
 jobtools.register_job(cycle_signal_job)
 
 
@@ -130,7 +134,8 @@ def test_modulation_cycle_signal():
     ds = modulation_cycle_signal(run_key, **cycle_signal_modulation_params).to_dataframe()
     print(ds)
     
-modulation_cycle_signal_job = jobtools.Job(precomputedir, 'modulation_cycle_signal', cycle_signal_modulation_params, modulation_cycle_signal)
+modulation_cycle_signal_job = jobtools.Job(precomputedir, 'modulation_cycle_signal', cycle_signal_modulation_params, modulation_cycle_signal,
+                                           depends_on=[(cycle_signal_job, None)])
 jobtools.register_job(modulation_cycle_signal_job)
     
 
@@ -141,6 +146,7 @@ def erp_signal(run_key, **p):
     Just compute average evoked potential signals according to respiratory timestamps 
     of each respiratory cycle
     """
+    assert p['edge_epochs'] == 'drop', f"edge_epochs {p['edge_epochs']} not supported"
     
     chans = p['chans'] # load computing chans
     chans = chans + ['resp_nose','resp_mouth','heart'] # add physio channels
@@ -158,48 +164,36 @@ def erp_signal(run_key, **p):
 
     window_size_points = int(p['window_size_secs'] * srate)
     
-    da_erp_signals = None 
-    
-    for chan in chans:
+    data = np.zeros((len(chans), times.size), dtype = eeg.dtype) # chan * time
+    for i, chan in enumerate(chans):
         if chan == 'resp_nose':
-            data = resp_sig.sel(chan='RespiNasale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 mins resp nose signal
+            data[i,:] = resp_sig.sel(chan='RespiNasale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 mins resp nose signal
         elif chan == 'resp_mouth':
-            data = -resp_sig.sel(chan='RespiVentrale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 min and reverse resp belt signal
+            data[i,:] = -resp_sig.sel(chan='RespiVentrale', time = slice(0, p['session_duration'])).values[:-1] # crop to 10 min and reverse resp belt signal
         elif chan == 'heart':
-            data = rri.values
+            data[i,:] = rri.values
         else:
-            data = eeg.sel(chan = chan).values
+            data[i,:] = eeg.sel(chan = chan).values
 
-        for transition in ['inspi_time','expi_time']:
-            timestamps = resp_features[transition].values
-            
-            epochs = None
-            for i, timestamp in enumerate(timestamps):
-                start_time = timestamp - p['start_window_size_before_transition_secs']
-                if start_time < 0:
-                    continue
-                start_ind = int(start_time * srate)
-                stop_ind = start_ind + window_size_points
-                if stop_ind > data.size:
-                    continue
-                epoch = data[start_ind:stop_ind]
-                epoch = epoch - np.mean(epoch) # center by mean
-
-                if epochs is None:
-                    epochs = np.zeros((timestamps.size, epoch.size))
-                epochs[i,:] = epoch
+    da_erp_signals = init_nan_da({'chan':chans, 
+                                  'transition':['inspi_time','expi_time'],
+                                  'feature':['mean','sd'], 
+                                  'time':np.arange(-p['start_window_size_before_transition_secs'], -p['start_window_size_before_transition_secs'] + p['window_size_secs'] , 1/srate)
+                                })
+
+    for transition in ['inspi_time','expi_time']:
+        timestamps = resp_features[transition].values
+        
+        # epochs by blocks of chans to bound memory, epochs overlapping session edges are dropped
+        for start in range(0, len(chans), erp_signal_chan_block_size):
+            block = slice(start, start + erp_signal_chan_block_size)
+            epochs, keep = epoch_signal(data[block], srate, timestamps, start_offset = -p['start_window_size_before_transition_secs'], n_points = window_size_points) # event * chan * time
+            epochs -= np.mean(epochs, axis = -1, keepdims = True) # center by mean, in place
             
-            evoked_mean = np.mean(epochs, axis = 0)
-            evoked_sd = np.std(epochs, axis = 0)
-
-            if da_erp_signals is None:
-                da_erp_signals = init_nan_da({'chan':chans, 
-                                              'transition':['inspi_time','expi_time'],
-                                              'feature':['mean','sd'], 
-                                              'time':np.arange(-p['start_window_size_before_transition_secs'], -p['start_window_size_before_transition_secs'] + p['window_size_secs'] , 1/srate)
-                                            })
-            da_erp_signals.loc[chan,transition,'mean',:] = evoked_mean
-            da_erp_signals.loc[chan,transition,'sd',:] = evoked_sd
+            da_erp_signals.loc[chans[block],transition,'mean',:] = np.mean(epochs, axis = 0)
+            da_erp_signals.loc[chans[block],transition,'sd',:] = np.std(epochs, axis = 0)
+            del epochs
+        da_erp_signals.attrs[f'n_dropped_{transition}'] = int(np.sum(~keep))
 
     ds = xr.Dataset()
     ds['erp_signal'] = da_erp_signals # store datarray in dataset
@@ -211,7 +205,9 @@ def test_erp_signal():
     ds = erp_signal(run_key, **erp_signal_params)
     print(ds)
     
-erp_signal_job = jobtools.Job(precomputedir, 'erp_signal', erp_signal_params, erp_signal)
+erp_signal_job = jobtools.Job(precomputedir, 'erp_signal', erp_signal_params, erp_signal,
+                              depends_on=[(eeg_interp_artifact_job, None), (rri_signal_job, None),
+                                          (convert_vhdr_job, None), (respiration_features_job, None)])
 jobtools.register_job(erp_signal_job) 
 
 
@@ -245,7 +241,8 @@ def test_concat_erp_signal():
     ds = concat_erp_signal(run_key, **concat_erp_signal_params)
     print(ds)
     
-concat_erp_signal_job = jobtools.Job(precomputedir, 'concat_erp_signal', concat_erp_signal_params, concat_erp_signal)
+concat_erp_signal_job = jobtools.Job(precomputedir, 'concat_erp_signal', concat_erp_signal_params, concat_erp_signal,
+                                     depends_on=[(erp_signal_job, lambda run_key: [(f'{sub}_{ses}',) for sub in subject_keys for ses in session_keys])])
 jobtools.register_job(concat_erp_signal_job) 
 
     
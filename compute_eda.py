@@ -58,7 +58,8 @@ def compute_all():
     jobtools.compute_job_list(eda_job, run_keys, force_recompute=False, engine='loop')
 
 
-eda_job = jobtools.Job(precomputedir, 'eda', eda_params, compute_eda_metrics)
+eda_job = jobtools.Job(precomputedir, 'eda', eda_params, compute_eda_metrics,
+                       depends_on=[(convert_vhdr_job, None)])
 jobtools.register_job(eda_job)
 
 
@@ -16,7 +16,7 @@ from compute_power_at_resp import power_at_resp_job
 from compute_rri import ecg_peak_job
 from compute_psycho import relaxation_job, maia_job, stai_longform_job, oas_job, bmrq_job
 from compute_resp_features import respiration_features_job
-from compute_rsa import rsa_features_job
+from compute_rsa import rsa_job, rsa_cycles_dataframe
 from compute_cycle_signal import modulation_cycle_signal_job
 
 
@@ -54,6 +54,40 @@ def get_bmrq_mapper():
     mapper_bmrq = {row['participant'] : row['BMRQ'] for i, row in bmrq.iterrows()} 
     return mapper_bmrq
 
+def gather_run_dataframes(job, run_keys, to_dataframe = None):
+    """
+    Read the outputs of a job for all run keys in bulk (thread pool, see jobtools.get_job_list) and concat them in one call.
+    to_dataframe(ds, run_key) converts one output to a dataframe (default : ds.to_dataframe()).
+    Return the concatenated dataframe and the run key of each of its rows
+    """
+    datasets = jobtools.get_job_list(job, run_keys)
+    if to_dataframe is None:
+        dfs = [ds.to_dataframe() for ds in datasets]
+    else:
+        dfs = [to_dataframe(ds, run_key) for ds, run_key in zip(datasets, run_keys)]
+    row_run_keys = np.repeat(np.array(run_keys), [df.shape[0] for df in dfs])
+    return pd.concat(dfs), row_run_keys
+
+def add_stai_long(df, row_run_keys):
+    """
+    Add stai_state and stai_trait columns (long form of ses02 of the participant of each row), read once by participant
+    """
+    keys = pd.unique(row_run_keys)
+    sub_keys = list(dict.fromkeys(key.split('_')[0] for key in keys))
+    jobtools.get_job_list(stai_longform_job, [f'{sub_key}_ses02' for sub_key in sub_keys]) # bulk read, then served by the get cache
+    stai = {sub_key : get_stai_long_mapper(sub_key) for sub_key in sub_keys}
+    rows = pd.Series(row_run_keys)
+    df['stai_state'] = rows.map({key : stai[key.split('_')[0]][0] for key in keys}).values
+    df['stai_trait'] = rows.map({key : stai[key.split('_')[0]][1] for key in keys}).values
+
+def add_keep_session(df, row_run_keys):
+    """
+    Add keep_session column (1 if the session of the row is clean of artifact else 0), computed once by run
+    """
+    keys = pd.unique(row_run_keys)
+    jobtools.get_job_list(count_artifact_job, list(dict.fromkeys(key.split('_')[0] for key in keys))) # bulk read, then served by the get cache
+    df['keep_session'] = pd.Series(row_run_keys).map({key : is_session_clean_of_artifact(key) for key in keys}).values
+
 #### JOBS
 # Next jobs aim to concanenate outputs from pre defined jobs in order to store it in one dataframe by job for all subjects and sessions
 # They loop over subjects and sessions and add some co-variable like state / trait axiety + OAS + BMRQ + gender + MAIA results
@@ -116,15 +150,8 @@ jobtools.register_job(maia_concat_job)
 # EDA
 
 def eda_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        df_run_key = eda_job.get(run_key).to_dataframe()
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(eda_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -140,27 +167,21 @@ jobtools.register_job(eda_concat_job)
 
 # HRV
 
-def hrv_concat(global_key, **p):
-    
-    concat = []
-    
-    for run_key in p['run_keys']:
-        participant, session = run_key.split('_')
-        
-        ecg_peaks = ecg_peak_job.get(run_key).to_dataframe()
-
-        metrics = physio.compute_ecg_metrics(ecg_peaks)
-        df_run_key = metrics.to_frame().T
-        df_run_key.insert(0 , 'session', session)
-        df_run_key.insert(0 , 'participant', participant)
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-
-        concat.append(df_run_key)
+def hrv_run_dataframe(ds, run_key):
+    """
+    HRV metrics of one run (one row) from its ecg peaks
+    """
+    participant, session = run_key.split('_')
+    ecg_peaks = ds.to_dataframe()
+    metrics = physio.compute_ecg_metrics(ecg_peaks)
+    df_run_key = metrics.to_frame().T
+    df_run_key.insert(0 , 'session', session)
+    df_run_key.insert(0 , 'participant', participant)
+    return df_run_key
 
-    df_return = pd.concat(concat)
+def hrv_concat(global_key, **p):
+    df_return, row_run_keys = gather_run_dataframes(ecg_peak_job, p['run_keys'], to_dataframe = hrv_run_dataframe) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -178,21 +199,14 @@ jobtools.register_job(hrv_concat_job)
     
 # RSA 
 
-def rsa_concat(global_key, **p):   
-    concat = []
-    for run_key in p['run_keys']:
-        df_run_key = rsa_features_job.get(run_key).to_dataframe()
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+def rsa_concat(global_key, **p):
+    df_return, row_run_keys = gather_run_dataframes(rsa_job, p['run_keys'], to_dataframe = rsa_cycles_dataframe) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
     df_return['BMRQ'] = df_return['participant'].map(get_bmrq_mapper())
-    return xr.Dataset(df_return.reset_index(drop = True))    
+    return xr.Dataset(df_return.reset_index(drop = True))
         
 def test_rsa_concat():
     ds = rsa_concat(global_key, **rsa_concat_params)
@@ -203,19 +217,9 @@ jobtools.register_job(rsa_concat_job)
 
 # BANDPOWER
 def bandpower_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        # mapper_keep_chans = get_bad_chan_mapper(run_key)
-        df_run_key = bandpower_job.get(run_key).to_dataframe()
-        # df_run_key['keep_chan'] = df_run_key['chan'].map(mapper_keep_chans)
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        keep = is_session_clean_of_artifact(run_key)
-        df_run_key['keep_session'] = keep
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(bandpower_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
+    add_keep_session(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -231,19 +235,9 @@ jobtools.register_job(bandpower_concat_job)
 
 # COHERENCE AT RESP
 def coherence_at_resp_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        # mapper_keep_chans = get_bad_chan_mapper(run_key)
-        df_run_key = coherence_at_resp_job.get(run_key).to_dataframe()
-        # df_run_key['keep_chan'] = df_run_key['chan'].map(mapper_keep_chans)
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        keep = is_session_clean_of_artifact(run_key)
-        df_run_key['keep_session'] = keep
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(coherence_at_resp_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
+    add_keep_session(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -260,19 +254,9 @@ jobtools.register_job(coherence_at_resp_concat_job)
 
 # POWER AT RESP
 def power_at_resp_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        # mapper_keep_chans = get_bad_chan_mapper(run_key)
-        df_run_key = power_at_resp_job.get(run_key).to_dataframe()
-        # df_run_key['keep_chan'] = df_run_key['chan'].map(mapper_keep_chans)
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        keep = is_session_clean_of_artifact(run_key)
-        df_run_key['keep_session'] = keep
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(power_at_resp_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
+    add_keep_session(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -289,15 +273,8 @@ jobtools.register_job(power_at_resp_concat_job)
 
 # RESP FEATURES
 def resp_features_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        df_run_key = respiration_features_job.get(run_key).to_dataframe()
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(respiration_features_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -314,14 +291,8 @@ jobtools.register_job(resp_features_concat_job)
 
 # RELAXATION
 def relaxation_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        df_run_key = relaxation_job.get(run_key).to_dataframe()
-        state, trait = get_stai_long_mapper(run_key)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(relaxation_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -337,19 +308,9 @@ jobtools.register_job(relaxation_concat_job)
 
 # CYCLE SIGNAL MODULATION
 def modulation_cycle_signal_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        # mapper_keep_chans = get_bad_chan_mapper(run_key)
-        df_run_key = modulation_cycle_signal_job.get(run_key).to_dataframe()
-        # df_run_key['keep_chan'] = df_run_key['chan'].map(mapper_keep_chans)
-        sub, ses = run_key.split('_')
-        state, trait = get_stai_long_mapper(sub)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        keep = is_session_clean_of_artifact(run_key)
-        df_run_key['keep_session'] = keep
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(modulation_cycle_signal_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
+    add_keep_session(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     df_return['OAS'] = df_return['participant'].map(get_oas_mapper())
@@ -365,14 +326,8 @@ jobtools.register_job(modulation_cycle_signal_concat_job)
 
 # OAS
 def oas_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        df_run_key = oas_job.get(run_key).to_dataframe()
-        state, trait = get_stai_long_mapper(run_key)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(oas_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     return xr.Dataset(df_return.reset_index(drop = True))
@@ -387,14 +342,8 @@ jobtools.register_job(oas_concat_job)
 
 # BMRQ
 def bmrq_concat(global_key, **p):
-    concat = []
-    for run_key in p['run_keys']:
-        df_run_key = bmrq_job.get(run_key).to_dataframe()
-        state, trait = get_stai_long_mapper(run_key)
-        df_run_key['stai_state'] = state
-        df_run_key['stai_trait'] = trait
-        concat.append(df_run_key)
-    df_return = pd.concat(concat)
+    df_return, row_run_keys = gather_run_dataframes(bmrq_job, p['run_keys']) # bulk read of the outputs of all runs
+    add_stai_long(df_return, row_run_keys)
     df_return['Gender'] = df_return['participant'].map(get_gender_mapper())
     df_return['Maia_Mean'] = df_return['participant'].map(get_maia_mapper())
     return xr.Dataset(df_return.reset_index(drop = True))
@@ -408,6 +357,47 @@ jobtools.register_job(bmrq_concat_job)
 
 
 
+# DEPENDENCIES (used by jobtools.compute_job_graph to resolve the graph of a concat job)
+def _all_keys(concat_params):
+    return lambda global_key: [(key,) for key in concat_params['run_keys']]
+
+def _all_stai_keys(concat_params, ses='ses02'):
+    return lambda global_key: [(f"{key.split('_')[0]}_{ses}",) for key in concat_params['run_keys']]
+
+def _all_sub_keys(concat_params):
+    return lambda global_key: [(key.split('_')[0],) for key in concat_params['run_keys']]
+
+maia_concat_job.add_dependency(maia_job, lambda global_key: [(sub_key,) for sub_key in maia_concat_params['subject_keys']])
+maia_concat_job.add_dependency(stai_longform_job, lambda global_key: [(f'{sub_key}_ses01',) for sub_key in maia_concat_params['subject_keys']])
+
+for concat_job, upstream_job, concat_params in [(eda_concat_job, eda_job, eda_concat_params),
+                                                (hrv_concat_job, ecg_peak_job, hrv_concat_params),
+                                                (rsa_concat_job, rsa_job, rsa_concat_params),
+                                                (bandpower_concat_job, bandpower_job, bandpower_concat_params),
+                                                (coherence_at_resp_concat_job, coherence_at_resp_job, coherence_at_resp_concat_params),
+                                                (power_at_resp_concat_job, power_at_resp_job, power_at_resp_concat_params),
+                                                (resp_features_concat_job, respiration_features_job, resp_features_concat_params),
+                                                (relaxation_concat_job, relaxation_job, relaxation_concat_params),
+                                                (modulation_cycle_signal_concat_job, modulation_cycle_signal_job, modulation_cycle_signal_concat_params),
+                                                (oas_concat_job, oas_job, oas_concat_params),
+                                                (bmrq_concat_job, bmrq_job, bmrq_concat_params),
+                                               ]:
+    concat_job.add_dependency(upstream_job, _all_keys(concat_params))
+    concat_job.add_dependency(stai_longform_job, _all_stai_keys(concat_params)) # get_stai_long_mapper()
+    concat_job.add_dependency(maia_concat_job, lambda global_key: (global_key,)) # get_maia_mapper()
+
+for concat_job in [eda_concat_job, hrv_concat_job, rsa_concat_job, bandpower_concat_job, coherence_at_resp_concat_job,
+                   power_at_resp_concat_job, resp_features_concat_job, relaxation_concat_job, modulation_cycle_signal_concat_job]:
+    concat_job.add_dependency(oas_concat_job, lambda global_key: (global_key,)) # get_oas_mapper()
+    concat_job.add_dependency(bmrq_concat_job, lambda global_key: (global_key,)) # get_bmrq_mapper()
+
+for concat_job, concat_params in [(bandpower_concat_job, bandpower_concat_params),
+                                  (coherence_at_resp_concat_job, coherence_at_resp_concat_params),
+                                  (power_at_resp_concat_job, power_at_resp_concat_params),
+                                  (modulation_cycle_signal_concat_job, modulation_cycle_signal_concat_params)]:
+    concat_job.add_dependency(count_artifact_job, _all_sub_keys(concat_params)) # is_session_clean_of_artifact()
+
+
 
 def compute_and_save_all():
     jobs = ['maia','bandpower','coherence_at_resp',
@@ -8,67 +8,64 @@ import numpy as np
 import jobtools
 
 from preproc import eeg_interp_artifact_job
-from compute_resp_features import respiration_features_job
+from compute_resp_features import respiration_features_job, compute_deform_operator
 
 from params import *
-from bibliotheque import init_nan_da, complex_mw, define_morlet_family, mad
-import physio
+from bibliotheque import init_nan_da, morlet_tf, mad, apply_deform_operator, epoch_signal
 
 
 #----------------------#
 #------- POWER --------#
 #----------------------#
 
-def sig_to_tf(sig, p, srate):
+def sig_to_tf(sigs, p, srate):
     """
-    Tool to compute time frequency from signal with complex morlet wavelets according to predefined params 
-    aiming to define the wavelets features
+    Tool to compute time frequency power from signal(s) (1D or chan * time) with complex morlet wavelets according to predefined params 
+    aiming to define the wavelets features. Signal is FFTed once and only the decimated samples are computed (see morlet_tf)
     """
     freqs = np.logspace(np.log10(p['f_start']), np.log10(p['f_stop']), num = p['n_freqs'], base = 10)
     cycles = np.logspace(np.log10(p['c_start']), np.log10(p['c_stop']), num = p['n_freqs'], base = 10)
 
-    mw_family = define_morlet_family(freqs = freqs , cycles = cycles, srate=srate)
+    power = morlet_tf(sigs, srate, freqs, cycles, decimate_factor = p['decimate_factor'], 
+                      amplitude_exponent = p['amplitude_exponent'], dtype = p['tf_dtype']) # power from time frequency complex map, already down sampled
+    return {'f':freqs, 'power':power} # return dict with freq vector and down sampled time-frequency power map
 
-    sigs = np.tile(sig, (p['n_freqs'],1))
-    tf = signal.fftconvolve(sigs, mw_family, mode = 'same', axes = 1)
-    return {'f':freqs, 'tf':tf} # return dict with freq vector and time-frequency map in complex domain
-
-def compute_power(sub, ses, chan, **p):
+def compute_power(sub, ses, **p):
     """
     Compute time frequency power maps of EEG signals by convolution with morlet wavelets
+    All channels of the session are computed at once from one EEG load : 
+    returns a dict {(sub, ses, chan) : ds} (multi output job, power_job.get(sub, ses, chan) gives one channel)
     """
     eeg = eeg_interp_artifact_job.get(sub,ses)['interp'] # load eeg
-    chans = eeg['chan'].values
     srate = eeg.attrs['srate']
     down_srate = srate /  p['decimate_factor'] # down sampling to reduce computation time
 
-    powers = None
-
-    sig = eeg.sel(chan = chan).values # select eeg signal
-    tf_dict = sig_to_tf(sig, p, srate) # compute time frequency complex map (with morlet wavelets)
-    power = np.abs(tf_dict['tf']) ** p['amplitude_exponent'] # extract power from time frequency complex map
-    power = signal.decimate(x = power, q = p['decimate_factor'], axis = 1) # down sampling power map in time axis to reduce storage size
-    t_down = np.arange(0, power.shape[1] / down_srate, 1 / down_srate) # compute the time vector of the down sampled power map
+    sigs = eeg.sel(chan = eeg_chans).values # select eeg signals (chan * time), read once
+    tf_dict = sig_to_tf(sigs, p, srate) # compute down sampled time frequency power maps of all channels (with morlet wavelets)
+    power = tf_dict['power'] # chan * freq * time
+    t_down = np.arange(power.shape[-1]) / down_srate # compute the time vector of the down sampled power map
 
-    if powers is None:
-        powers = init_nan_da({'freq':tf_dict['f'], # initialize a dataarray freq * time
-                            'time':t_down})
-                            
-    powers.loc[:,:] = power # store power map in dataarray
-
-    powers.attrs['down_srate'] = down_srate # store sampling rate of the down sampled power map as a attribute
-    
-    ds = xr.Dataset()
-    ds['power'] = powers # store in dataset
-    return ds
+    outputs = {}
+    for i, chan in enumerate(eeg_chans):
+        powers = xr.DataArray(data = power[i], dims = ['freq','time'], coords = {'freq':tf_dict['f'], 'time':t_down}) # dataarray freq * time
+        powers.attrs['down_srate'] = down_srate # store sampling rate of the down sampled power map as a attribute
+        
+        ds = xr.Dataset()
+        ds['power'] = powers # store in dataset
+        outputs[(sub, ses, chan)] = ds
+    return outputs
 
 def test_compute_power():
     sub, ses, chan = 'P30' , 'odor', 'Cz'
-    ds = compute_power(sub, ses, chan, **power_params)
-    print(ds)
+    outputs = compute_power(sub, ses, **power_params)
+    print(outputs[(sub, ses, chan)])
     
 
-power_job = jobtools.Job(precomputedir, 'power', power_params, compute_power)
+power_job = jobtools.Job(precomputedir, 'power', power_params, compute_power,
+                         depends_on=[(eeg_interp_artifact_job, lambda sub, ses, chan: (f'{sub}_{ses}',))],
+                         storage=jobtools.ZarrStorage(chunks={'freq':15, 'time':10000}), # chunked + compressed power maps
+                         group_keys=lambda sub, ses, chan: (sub, ses), # one task computes all the channels of a session
+                         group_members=lambda sub, ses: [(sub, ses, chan) for chan in eeg_chans])
 jobtools.register_job(power_job)
 
 
@@ -83,7 +80,7 @@ def compute_baseline(sub, chan, **p):
     for each frequency bin (so on time axis) from baseline session
     """
     baseline_power = power_job.get(sub, 'baseline', chan)['power'] # load power map of baseline session
-    baseline_power[:] = baseline_power.values # load into memory
+    baseline_power = baseline_power.load() # load into memory
     
     baselines = None 
     
@@ -105,7 +102,8 @@ def test_compute_baseline():
     ds = compute_baseline(sub, chan, **baseline_params)
     print(ds)
     
-baseline_job = jobtools.Job(precomputedir, 'baseline',baseline_params, compute_baseline)
+baseline_job = jobtools.Job(precomputedir, 'baseline',baseline_params, compute_baseline,
+                            depends_on=[(power_job, lambda sub, chan: (sub, 'baseline', chan))])
 jobtools.register_job(baseline_job)
 
 
@@ -138,16 +136,13 @@ def compute_phase_frequency(sub, ses, chan, **p):
     baselines = baseline_job.get(sub, chan)['baseline'] # load baseline features
 
     cycle_features = respiration_features_job.get(sub, ses).to_dataframe() # load resp features
-    cycle_times = cycle_features[['inspi_time','expi_time','next_inspi_time']].values # get respi times for deformation of the map
+    deform = phase_freq_deform_job.get(f'{sub}_{ses}') # sparse operator of cyclical deformation according to respiratory timestamps
     
     mask_artifact = cycle_features['artifact'] == 0
     inds_resp_cycle_sel = cycle_features[mask_artifact].index # select inds of resp cycles without cooccuring EEG artifacting
     
     baseline_modes = ['z_score','rz_score']
     
-    phase_freq_power = None 
-    
-        
     power = powers.values
                     
     baseline = {'mean':baselines.loc['mean',:].values,
@@ -156,33 +151,25 @@ def compute_phase_frequency(sub, ses, chan, **p):
                 'mad':baselines.loc['mad',:].values
                 }
     
-    for mode in baseline_modes: # loop over baseline modes (z-score or robust z-score)
+    # deform the raw power map once according to respiratory timestamps to get a phase representation of it
+    deformed_data_stacked = apply_deform_operator(deform, power.T, times = times) # all frequencies in one matrix product
+    deformed_data_stacked = deformed_data_stacked[inds_resp_cycle_sel,:,:] # keep only non artifacted cycles
+
+    # compress cycle axis : all quantiles in one pass (one sort) + mean
+    quantiles = [compress for compress in p['compress_cycle_modes'] if compress != 10]
+    quantile_values = np.quantile(deformed_data_stacked, q = quantiles, axis = 0) # quantile * phase * freq
+    compressed = {compress:quantile_values[i] for i, compress in enumerate(quantiles)}
+    compressed[10] = np.mean(deformed_data_stacked, axis = 0) # mean over cycle axis
     
-        power_norm = apply_baseline_normalization(power = power.T, baseline = baseline, mode = mode) # normalize power according to the mode
-        
-        # deform the normalized power map according to respiratory timestamps to get a phase representation of it
-        deformed_data_stacked = physio.deform_traces_to_cycle_template(data = power_norm, 
-                                                                        times = times, 
-                                                                        cycle_times=cycle_times, 
-                                                                        segment_ratios = p['segment_ratios'], 
-                                                                        points_per_cycle = p['n_phase_bins'])
-
-
-        
-        deformed_data_stacked = deformed_data_stacked[inds_resp_cycle_sel,:,:] # keep only non artifacted cycles
+    phase_freq_power = init_nan_da({'baseline_mode':baseline_modes, 
+                                    'compress_cycle_mode':p['compress_cycle_modes'], # different cycle axis compression methods 
+                                    'freq':freqs, 
+                                    'phase':np.linspace(0,1,p['n_phase_bins'])})
     
-        
-        if phase_freq_power is None: # initalize phase frequency dataarray
-            phase_freq_power = init_nan_da({'baseline_mode':baseline_modes, 
-                                        'compress_cycle_mode':p['compress_cycle_modes'], # different cycle axis compression methods 
-                                        'freq':freqs, 
-                                        'phase':np.linspace(0,1,p['n_phase_bins'])})
-
+    # baseline normalization is affine and increasing by frequency : normalizing after deformation / compression is the same than before
+    for mode in baseline_modes: # loop over baseline modes (z-score or robust z-score)
         for compress in p['compress_cycle_modes']: # loop of cycle axis compression methods and store the output at the right location in dataarray
-            if compress == 10:
-                phase_freq_power.loc[mode, compress, :,:] = np.mean(deformed_data_stacked, axis = 0).T # mean over cycle axis
-            else:
-                phase_freq_power.loc[mode, compress, :,:] = np.quantile(deformed_data_stacked, q = compress, axis = 0).T # quantile computing over cycle axis
+            phase_freq_power.loc[mode, compress, :,:] = apply_baseline_normalization(power = compressed[compress], baseline = baseline, mode = mode).T # normalize according to the mode
             
     ds = xr.Dataset()
     ds['phase_freq'] = phase_freq_power
@@ -195,7 +182,15 @@ def test_compute_phase_frequency():
     print(ds)
     
 
-phase_freq_job = jobtools.Job(precomputedir, 'phase_freq', phase_freq_params, compute_phase_frequency)
+phase_freq_deform_job = jobtools.Job(precomputedir, 'phase_freq_deform', phase_freq_deform_params, compute_deform_operator,
+                                     depends_on=[(respiration_features_job, None)])
+jobtools.register_job(phase_freq_deform_job)
+
+phase_freq_job = jobtools.Job(precomputedir, 'phase_freq', phase_freq_params, compute_phase_frequency,
+                              depends_on=[(power_job, None),
+                                          (baseline_job, lambda sub, ses, chan: (sub, chan)),
+                                          (respiration_features_job, lambda sub, ses, chan: (f'{sub}_{ses}',)),
+                                          (phase_freq_deform_job, lambda sub, ses, chan: (f'{sub}_{ses}',))])
 jobtools.register_job(phase_freq_job)
 
 
@@ -232,7 +227,9 @@ def test_phase_freq_concat():
     ds = phase_freq_concat(chan, **phase_freq_concat_params)
     print(ds['phase_freq_concat'])
     
-phase_freq_concat_job = jobtools.Job(precomputedir, 'phase_freq_concat', phase_freq_concat_params, phase_freq_concat)
+phase_freq_concat_job = jobtools.Job(precomputedir, 'phase_freq_concat', phase_freq_concat_params, phase_freq_concat,
+                                     depends_on=[(phase_freq_job, lambda chan: [(sub, ses, chan) for sub in phase_freq_concat_params['sub_keys']
+                                                                                                for ses in phase_freq_concat_params['ses_keys']])])
 jobtools.register_job(phase_freq_concat_job)
 
 
@@ -249,7 +246,7 @@ def compute_erp_time_freq(sub, ses, chan, **p):
     half_window_duration = p['half_window_duration']
 
     power_all = power_job.get(sub, ses, chan)['power'] # load power
-    power_all[:] = power_all.values
+    power_all = power_all.load()
 
     down_srate = power_all.attrs['down_srate']
 
@@ -261,14 +258,13 @@ def compute_erp_time_freq(sub, ses, chan, **p):
     # print(resp_sel.iloc[-1,:]['inspi_time'] * down_srate + half_window_duration * down_srate)
 
     baselines = baseline_job.get(sub, chan)['baseline'] # load baseline features
-    baselines[:] = baselines.values
+    baselines = baselines.load()
     baseline_modes = ['z_score','rz_score']
 
+    assert p['edge_epochs'] == 'drop', f"edge_epochs {p['edge_epochs']} not supported"
     centers_slice = ['inspi_time','expi_time']
     win_size_points = int(half_window_duration * 2 * down_srate) # prepare window size
     
-    erp_power = None
-
     power = power_all.values
 
     baseline_dict = {
@@ -278,37 +274,24 @@ def compute_erp_time_freq(sub, ses, chan, **p):
                 'mad':baselines.loc['mad',:].values
                 }
 
-    for mode in baseline_modes: # loop over normalization methods
-        power_norm = apply_baseline_normalization(power = power.T, baseline = baseline_dict, mode = mode).T # normalize
-
-        erp_power_chan = None
-
-        for center_slice in centers_slice: # loop over respi transitions (inspi-expi and expi-inspi)
-
-            for ind_c, c in resp_sel.iterrows(): # loop over resp cycles
-                win_center = c[center_slice] # select resp timestamp
-                win_start = win_center - half_window_duration # compute start time of window
-                win_start_point = int(win_start * down_srate)  # compute start ind of window
-                win_stop_point = win_start_point + win_size_points  # compute stop ind of window
-                win = np.arange(win_start_point, win_stop_point) # compute window ind vector
+    erp_power = init_nan_da({'baseline_mode':baseline_modes,
+                             'center':centers_slice,
+                             'freq':power_all['freq'].values,
+                             'time':np.arange(-half_window_duration, half_window_duration , 1 / down_srate)})
 
-                if erp_power_chan is None: # initialize right shaped datarray
-                    erp_power_chan = init_nan_da({'cycle':resp_sel.index,
-                                                'freq':power_all['freq'].values,
-                                                'time':np.arange(-half_window_duration, half_window_duration , 1 / down_srate)})
-                
-                erp_power_chan.loc[ind_c, : ,:] = power_norm[:,win] # select power of the window and store in a the right location (cycle)
-
-            if erp_power is None:
-                erp_power = init_nan_da({'baseline_mode':baseline_modes,
-                                    'center':centers_slice,
-                                    'freq':power_all['freq'].values,
-                                    'time':erp_power_chan.coords['time'].values})
-            
-            if type(p['compress_cycle_mode']) is str:
-                erp_power.loc[mode, center_slice, :,:] = erp_power_chan.mean(dim = 'cycle').values # average over resp cycles axis
-            elif type(p['compress_cycle_mode']) is float:
-                erp_power.loc[mode, center_slice, :,:] = erp_power_chan.quantile(dim = 'cycle', q = p['compress_cycle_mode']).values # quantile computing over resp cycles axis
+    for center_slice in centers_slice: # loop over respi transitions (inspi-expi and expi-inspi)
+        # windows of all resp cycles at once on raw power (epochs overlapping session edges are dropped)
+        erp_power_chan, keep = epoch_signal(power, down_srate, resp_sel[center_slice].values, start_offset = -half_window_duration, n_points = win_size_points) # cycle * freq * time
+        erp_power.attrs[f'n_dropped_{center_slice}'] = int(np.sum(~keep))
+        
+        if type(p['compress_cycle_mode']) is str:
+            compressed = np.mean(erp_power_chan, axis = 0) # average over resp cycles axis
+        elif type(p['compress_cycle_mode']) is float:
+            compressed = np.quantile(erp_power_chan, q = p['compress_cycle_mode'], axis = 0) # quantile computing over resp cycles axis
+        
+        # baseline normalization is affine and increasing by frequency : normalizing after compression is the same than before
+        for mode in baseline_modes: # loop over normalization methods
+            erp_power.loc[mode, center_slice, :,:] = apply_baseline_normalization(power = compressed.T, baseline = baseline_dict, mode = mode).T # normalize
      
     erp_power.attrs['down_srate'] = down_srate
     ds = xr.Dataset()
@@ -320,7 +303,10 @@ def test_compute_erp_time_freq():
     ds = compute_erp_time_freq(sub, ses,chan, **erp_time_freq_params)
     print(ds['erp_time_freq'])
 
-erp_time_freq_job = jobtools.Job(precomputedir, 'erp_time_freq', erp_time_freq_params, compute_erp_time_freq)
+erp_time_freq_job = jobtools.Job(precomputedir, 'erp_time_freq', erp_time_freq_params, compute_erp_time_freq,
+                                 depends_on=[(power_job, None),
+                                             (baseline_job, lambda sub, ses, chan: (sub, chan)),
+                                             (respiration_features_job, lambda sub, ses, chan: (f'{sub}_{ses}',))])
 jobtools.register_job(erp_time_freq_job)
 
 def erp_time_freq_concat(chan, **p):
@@ -354,7 +340,9 @@ def test_erp_time_freq_concat():
     ds = erp_time_freq_concat(chan, **erp_time_freq_concat_params)
     print(ds['erp_concat'])
 
-erp_concat_job = jobtools.Job(precomputedir, 'erp_time_freq_concat', erp_time_freq_concat_params, erp_time_freq_concat)
+erp_concat_job = jobtools.Job(precomputedir, 'erp_time_freq_concat', erp_time_freq_concat_params, erp_time_freq_concat,
+                              depends_on=[(erp_time_freq_job, lambda chan: [(sub, ses, chan) for sub in erp_time_freq_concat_params['sub_keys']
+                                                                                             for ses in erp_time_freq_concat_params['ses_keys']])])
 jobtools.register_job(erp_concat_job)
  
 
@@ -365,6 +353,14 @@ jobtools.register_job(erp_concat_job)
 #----------------------#
 
 def compute_all():
+    # whole graph (eeg_interp -> power -> baseline -> phase_freq ...) resolved and run level by level
+    # run_keys_pf = [(sub, ses, chan) for sub in subject_keys for ses in session_keys for chan in eeg_chans]
+    # jobtools.compute_job_graph(phase_freq_job, run_keys_pf, force_recompute=False, engine='joblib', n_jobs = 6)
+
+    # slurm_params measured from previous runs (run ledger) instead of guessed
+    # print(jobtools.ledger_report(precomputedir))
+    # slurm_params = jobtools.suggest_slurm_params(precomputedir, 'power')
+
     # run_keys = [(sub, ses, chan) for sub in subject_keys for ses in session_keys for chan in eeg_chans]
     # jobtools.compute_job_list(power_job, run_keys, force_recompute=False, engine='loop')
     # jobtools.compute_job_list(power_job, run_keys, force_recompute=False, engine='slurm',
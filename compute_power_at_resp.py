@@ -5,8 +5,7 @@ import pandas as pd
 import jobtools
 import ghibtools as gh
 from compute_psd import psd_eeg_job
-from preproc import convert_vhdr_job
-import physio
+from compute_resp_features import respiration_job
 
 def compute_power_at_resp(run_key, **p):
     """
@@ -17,20 +16,17 @@ def compute_power_at_resp(run_key, **p):
     psd_eeg = psd_eeg_job.get(run_key)['psd'] # load psd of eeg
     srate = psd_eeg.attrs['srate']
     
-    resp_sig = convert_vhdr_job.get(run_key)['raw'].sel(chan = p['resp_chan'], time = slice(0,p['session_duration'])).values[:-1] # load raw resp
-    resp_sig, resp_cycles = physio.compute_respiration(resp_sig, srate, parameter_preset='human_airflow') # preproc resp
-
-    f_resp, Pxx_resp = gh.spectre(resp_sig, srate, p['lowest_freq_psd_resp']) # compute power spectrum of resp
-    Pxx_resp_sel = Pxx_resp[f_resp<1] # zoom on frequencies < 1 Hz
-    max_resp = np.max(Pxx_resp_sel) # compute max power value
-    argmax_resp = np.argmax(Pxx_resp_sel) # get index of max power value
-    fmax_resp = f_resp[argmax_resp] # get frequency bin of max power value
+    ds_resp = respiration_job.get(run_key) # load resp spectrum computed on the frequency grid of psd_eeg
+    max_resp = float(ds_resp[f"max_{p['resp_spectrum']}"]) # max power value of resp spectrum < 1 Hz
+    fmax_resp = float(ds_resp[f"fmax_{p['resp_spectrum']}"]) # frequency bin of max power value
+    freq_resp = ds_resp[f"freq_{p['resp_spectrum']}"].values
+    assert freq_resp.shape == psd_eeg['freq'].shape and np.allclose(freq_resp, psd_eeg['freq'].values), 'resp spectrum and EEG psd must share their frequency grid (same windowing in params.py)'
 
     rows = []
     
     for chan in psd_eeg.coords['chan'].values: # loop over chans
 
-        max_eeg = float(psd_eeg.loc[chan , fmax_resp]) # get power spectrum value of eeg at frequency of max power of resp 
+        max_eeg = float(psd_eeg.sel(chan = chan).sel(freq = fmax_resp, method = 'nearest')) # get power spectrum value of eeg at frequency of max power of resp (same grid, checked above)
         row = [participant, session, chan,  fmax_resp, max_resp, max_eeg]
         rows.append(row)
 
@@ -45,7 +41,8 @@ def test_compute_power_at_resp():
     print(ds_power_at_resp.to_dataframe())
     
 
-power_at_resp_job = jobtools.Job(precomputedir, 'power_at_resp', power_at_resp_params, compute_power_at_resp)
+power_at_resp_job = jobtools.Job(precomputedir, 'power_at_resp', power_at_resp_params, compute_power_at_resp,
+                                 depends_on=[(psd_eeg_job, None), (respiration_job, None)])
 jobtools.register_job(power_at_resp_job)
 
 
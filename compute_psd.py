@@ -1,37 +1,54 @@
 from configuration import *
 from params import *
 import xarray as xr
-import physio
 import jobtools
 import ghibtools as gh
-from bibliotheque import init_nan_da
 from preproc import eeg_interp_artifact_job
 
 
-### PSD LF
-def compute_psd(run_key, **p):
+### PSD (all resolutions from one EEG load)
+def multichan_spectre(eeg, lowest_freq, name = None):
     """
-    Compute power spectrum of EEG (lowest freq = 0.1 Hz)
+    Welch power spectra of all the chans of an EEG DataArray (chan * time) in one call of gh.spectre along the time axis
     """
-    
-    eeg = eeg_interp_artifact_job.get(run_key)['interp'] # load
     srate = eeg.attrs['srate']
+    f , Pxx = gh.spectre(eeg.values, srate, lowest_freq) # welch method to compute power spectrum with windows containing at least 5 cycles of the set "lowest frequency"
+    psd = xr.DataArray(data = Pxx.astype('float64'), dims = ['chan','freq'], coords = {'chan':eeg.coords['chan'].values, 'freq':f}, name = name)
+    psd.attrs['srate'] = srate
+    return psd
+
+
+def compute_psd_resolutions(run_key, **p):
+    """
+    Compute power spectra of EEG at the resolutions of psd_eeg_job (lowest freq = 0.1 Hz) and psd_bandpower_job (lowest freq = 1 Hz)
+    from a single load of the EEG
+    """
+    eeg = eeg_interp_artifact_job.get(run_key)['interp'].load() # load all chans once
     
-    psd = None
+    ds = xr.Dataset()
+    ds['psd'] = multichan_spectre(eeg, p['psd_params']['lowest_freq'])
+    ds['psd_bandpower'] = multichan_spectre(eeg, p['psd_bandpower_params']['lowest_freq']).rename(freq = 'freq_bandpower')
+    return ds
+
+
+def test_compute_psd_resolutions():
+    run_key = 'P02_baseline'
+    psd_ds = compute_psd_resolutions(run_key, **psd_resolutions_params)
+    print(psd_ds)
     
-    for chan in eeg.coords['chan'].values: # loop on chans
-        sig = eeg.sel(chan=chan).values
-        f , Pxx = gh.spectre(sig, srate, p['lowest_freq']) # welch method to compute power spectrum with windows containing at least 5 cycles of the set "lowest frequency"
-        
-        if psd is None:
-            psd = init_nan_da({'chan':eeg.coords['chan'].values, # initialize datarray at the first iteration
-                               'freq':f}) 
-            
-        psd.loc[chan, : ] = Pxx #  store spectrum of the chan in a datarray
-                    
-    psd.attrs['srate'] = srate
+
+psd_resolutions_job = jobtools.Job(precomputedir, 'psd_resolutions', psd_resolutions_params, compute_psd_resolutions,
+                                   depends_on=[(eeg_interp_artifact_job, None)])
+jobtools.register_job(psd_resolutions_job)
+
+
+### PSD LF
+def compute_psd(run_key, **p):
+    """
+    Compute power spectrum of EEG (lowest freq = 0.1 Hz) (read from psd_resolutions_job)
+    """
     psd_ds = xr.Dataset()
-    psd_ds['psd'] = psd # store datarray in dataset
+    psd_ds['psd'] = psd_resolutions_job.get(run_key)['psd'] # store datarray in dataset
     return psd_ds 
 
 
@@ -41,33 +58,18 @@ def test_compute_psd():
     print(psd_ds)
     
     
-psd_eeg_job = jobtools.Job(precomputedir, 'psd_eeg', psd_params, compute_psd)
+psd_eeg_job = jobtools.Job(precomputedir, 'psd_eeg', psd_params, compute_psd,
+                           depends_on=[(psd_resolutions_job, None)])
 jobtools.register_job(psd_eeg_job)
 
 
 ### PSD BANDPOWER
 def compute_psd_bandpower(run_key, **p):
     """
-    Compute power spectrum of EEG (lowest freq = 1 Hz) ready to extract bandpower
+    Compute power spectrum of EEG (lowest freq = 1 Hz) ready to extract bandpower (read from psd_resolutions_job)
     """
-    
-    eeg = eeg_interp_artifact_job.get(run_key)['interp'] # load
-    srate = eeg.attrs['srate']
-    
-    psd = None
-    
-    for chan in eeg.coords['chan'].values: # loop on chans
-        sig = eeg.sel(chan=chan).values
-        f , Pxx = gh.spectre(sig, srate, p['lowest_freq']) # welch method to compute power spectrum with windows containing at least 5 cycles of the set "lowest frequency"
-        
-        if psd is None:
-            psd = init_nan_da({'chan':eeg.coords['chan'].values, # initialize datarray at the first iteration
-                               'freq':f})
-            
-        psd.loc[chan, : ] = Pxx  #  store spectrum of the chan in a datarray    
-    psd.attrs['srate'] = srate
     psd_ds = xr.Dataset()
-    psd_ds['psd_bandpower'] = psd # store datarray in dataset
+    psd_ds['psd_bandpower'] = psd_resolutions_job.get(run_key)['psd_bandpower'].rename(freq_bandpower = 'freq') # store datarray in dataset
     return psd_ds
 
 def test_compute_psd_bandpower():
@@ -75,7 +77,8 @@ def test_compute_psd_bandpower():
     psd_ds = compute_psd_bandpower(run_key, **psd_bandpower_params)
     print(psd_ds)
     
-psd_bandpower_job = jobtools.Job(precomputedir, 'psd_bandpower', psd_bandpower_params, compute_psd_bandpower)
+psd_bandpower_job = jobtools.Job(precomputedir, 'psd_bandpower', psd_bandpower_params, compute_psd_bandpower,
+                                 depends_on=[(psd_resolutions_job, None)])
 jobtools.register_job(psd_bandpower_job)
 
 # psd_baselined
@@ -98,18 +101,22 @@ def test_psd_baselined():
     psd_ds = psd_baselined(run_key, **psd_baselined_params)
     print(psd_ds)
     
-psd_baselined_job = jobtools.Job(precomputedir, 'psd_baselined', psd_baselined_params, psd_baselined)
+psd_baselined_job = jobtools.Job(precomputedir, 'psd_baselined', psd_baselined_params, psd_baselined,
+                                 depends_on=[(psd_bandpower_job, None),
+                                             (psd_bandpower_job, lambda run_key: (run_key.split('_')[0] + '_baseline',))])
 jobtools.register_job(psd_baselined_job)
 
 
 
 def compute_all():
+    # jobtools.compute_job_list(psd_resolutions_job, run_keys, force_recompute=False, engine='loop')
     # jobtools.compute_job_list(psd_eeg_job, run_keys, force_recompute=False, engine='loop')
     # jobtools.compute_job_list(psd_bandpower_job, run_keys, force_recompute=False, engine='loop')
     jobtools.compute_job_list(psd_baselined_job, stim_keys, force_recompute=False, engine='loop')
     
     
 if __name__ == '__main__':
+    # test_compute_psd_resolutions()
     # test_compute_psd()
     # test_compute_psd_bandpower()
     # test_psd_baselined()
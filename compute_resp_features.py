@@ -2,42 +2,75 @@ from configuration import *
 from params import *
 import xarray as xr
 import jobtools
+import ghibtools as gh
 from preproc import convert_vhdr_job, artifact_job
+from bibliotheque import deform_operator
+from bibliotheque_artifact_detection import overlap_intervals
 
-def compute_respiration_features(run_key, **p):
+def compute_respiration(run_key, **p):
     """
-    Compute respiration features from raw resp signal and 
-    annotate cycles according to cooccuring artifacting of EEG signals
+    Preproc resp signal, compute resp cycles, resp power spectra and dominant respiratory frequency.
+    Computed once by run and then read by all the resp consumers (resp features, coherence, power at resp)
     """
     import physio 
     
-    sub, ses = run_key.split('_')
-    
     raw_dataset = convert_vhdr_job.get(run_key) # load raw data
     
-    resp_raw = raw_dataset['raw'].sel(chan='RespiNasale', time = slice(0, p['session_duration'])).values[:-1] # get raw resp
+    resp_raw = raw_dataset['raw'].sel(chan=p['resp_chan'], time = slice(0, p['session_duration'])).values[:-1] # get raw resp
     srate = raw_dataset['raw'].attrs['srate']
     
     if p['inspiration_sign'] == '+': # invert signal to have inhalation below 0
         resp_raw = -resp_raw
 
     resp, resp_cycles = physio.compute_respiration(resp_raw, srate, parameter_preset='human_airflow') # preproc resp and compute resp cycle features
+    times = np.arange(resp.size) / srate
+    
+    ds = xr.Dataset(resp_cycles.reset_index(drop=True).rename_axis('cycle')) # cycle table on its own dim
+    ds['resp'] = xr.DataArray(data = resp, dims = ['time'], coords = {'time':times})
+    
+    for spectrum_name, spectrum_params in p['spectrum_params'].items(): # one spectrum by frequency grid of the eeg spectra to compare with
+        welch_kwargs = {k:v for k, v in spectrum_params.items() if k != 'lowest_freq'}
+        f, Pxx = gh.spectre(resp, srate, spectrum_params['lowest_freq'], **welch_kwargs) # compute power spectrum of resp
+        ds[f'psd_{spectrum_name}'] = xr.DataArray(data = Pxx, dims = [f'freq_{spectrum_name}'], coords = {f'freq_{spectrum_name}':f})
+        
+        Pxx_sel = Pxx[f < p['fmax_search_max']] # zoom on frequencies < 1 Hz
+        ds[f'max_{spectrum_name}'] = np.max(Pxx_sel) # max power value
+        ds[f'fmax_{spectrum_name}'] = f[np.argmax(Pxx_sel)] # frequency bin of max power value
+    
+    ds.attrs['srate'] = srate
+    
+    return ds
+
+
+def test_compute_respiration():
+    run_key = 'P02_baseline'
+    ds = compute_respiration(run_key, **respiration_params)
+    print(ds)
+
+
+def compute_respiration_features(run_key, **p):
+    """
+    Compute respiration features from raw resp signal and 
+    annotate cycles according to cooccuring artifacting of EEG signals
+    """
+    sub, ses = run_key.split('_')
+    
+    ds_resp = respiration_job.get(run_key) # load preprocessed resp and resp cycles
+    
+    cycle_vars = [v for v in ds_resp.data_vars if ds_resp[v].dims == ('cycle',)]
+    resp_cycles = ds_resp[cycle_vars].to_dataframe()
+    resp_cycles.index.name = None
     resp_cycles['participant'] = sub
     resp_cycles['session'] = ses
     
     artifacts = artifact_job.get(run_key).to_dataframe() # load timestamps of EEG artifacts
     
     resp_artifacted = resp_cycles.copy()
-    resp_artifacted['artifact'] = 0
     
-    for i, cycle_respi in resp_artifacted.iterrows(): # loop over resp cycles
-        window_cycle_respi = np.arange(cycle_respi['inspi_index'], cycle_respi['next_inspi_index']) # construct an index time vector of the current resp cycle
-        
-        for j, artifact in artifacts.iterrows(): # loop over artifacts
-            window_artifact = np.arange(artifact['start_ind'], artifact['stop_ind']) # construct an index time vector of the current artifact 
-            
-            if sum(np.in1d(window_cycle_respi, window_artifact)) != 0: # see if index vector of current resp cycle and current artifact are overlapping or not
-                resp_artifacted.loc[i, 'artifact'] = 1 # resp cycle is marked by 1 value if an artifacted overlap itself
+    # resp cycle is marked by 1 value if an artifact overlaps itself (index windows [inspi_index, next_inspi_index) and [start_ind, stop_ind))
+    overlap = overlap_intervals(resp_cycles['inspi_index'].values, resp_cycles['next_inspi_index'].values, 
+                                artifacts['start_ind'].values, artifacts['stop_ind'].values)
+    resp_artifacted['artifact'] = overlap.astype('int64')
     
     ds = xr.Dataset(resp_artifacted)
     
@@ -50,14 +83,33 @@ def test_compute_respiration_features():
     print(ds.to_dataframe())
      
     
+def compute_deform_operator(run_key, **p):
+    """
+    Compute the sparse operator of cyclical deformation (to respiratory cycle template) of traces 
+    sampled at p['srate'] (p['n_times'] samples from t = 0). Built once by run and then applied 
+    to all channels / frequencies in one matrix product (see bibliotheque.apply_deform_operator)
+    """
+    resp_features = respiration_features_job.get(run_key).to_dataframe() # load resp features
+    cycle_times = resp_features[['inspi_time','expi_time','next_inspi_time']].values # extract resp cycle times to deform signals
+    times = np.arange(p['n_times']) / p['srate']
+    return deform_operator(times, cycle_times, points_per_cycle = p['n_phase_bins'], segment_ratios = p['segment_ratios'])
+     
+    
 def compute_all():
+    # jobtools.compute_job_list(respiration_job, run_keys, force_recompute=False, engine='loop')
     jobtools.compute_job_list(respiration_features_job, run_keys, force_recompute=False, engine='loop')
 
     
-respiration_features_job = jobtools.Job(precomputedir, 'respiration_features', respiration_features_params, compute_respiration_features)
+respiration_job = jobtools.Job(precomputedir, 'respiration', respiration_params, compute_respiration,
+                               depends_on=[(convert_vhdr_job, None)])
+jobtools.register_job(respiration_job)
+
+respiration_features_job = jobtools.Job(precomputedir, 'respiration_features', respiration_features_params, compute_respiration_features,
+                                        depends_on=[(respiration_job, None), (artifact_job, None)])
 jobtools.register_job(respiration_features_job)
 
 
 if __name__ == '__main__':
+    # test_compute_respiration()
     # test_compute_respiration_features()
     compute_all()
\ No newline at end of file
@@ -4,34 +4,67 @@ import xarray as xr
 import jobtools
 from preproc import convert_vhdr_job
 from compute_resp_features import respiration_features_job
+from bibliotheque import events_to_cycle_phase
 import matplotlib.pyplot as plt
 
 
-def compute_ecg(run_key, **p):
+def compute_cardiac(run_key, **p):
     """
-    Preproc ECG
+    Preproc ECG, detect R peaks and compute heart rate signal in a single physio pass
     """
     import physio
     
+    ecg_p = p['ecg_params']
     raw_dataset = convert_vhdr_job.get(run_key) # load
     
-    ecg_raw = raw_dataset['raw'].sel(chan='ECG', time = slice(0, p['session_duration'])).values[:-1] # sel ECG and crop to 10 mins
+    ecg_raw = raw_dataset['raw'].sel(chan='ECG', time = slice(0, ecg_p['session_duration'])).values[:-1] # sel ECG and crop to 10 mins
     srate = raw_dataset['raw'].attrs['srate']
     
     subject_key, ses_key = run_key.split('_')
 
-    inv = p['ecg_inversion'][subject_key]
+    inv = ecg_p['ecg_inversion'][subject_key]
     ecg_raw_inv = ecg_raw * inv # invert ECG signal accoding to dictionnary in params.py
     
     parameters = physio.get_ecg_parameters('human_ecg') # load physio default parameters
-    parameters['peak_detection']['thresh'] = p['thresh'] # modify threshold parameter for peak detection
-    ecg, ecg_peaks = physio.compute_ecg(ecg_raw_inv, srate, parameters=parameters) # preproc ecg
+    parameters['peak_detection']['thresh'] = ecg_p['thresh'] # modify threshold parameter for peak detection
+    ecg, ecg_peaks = physio.compute_ecg(ecg_raw_inv, srate, parameters=parameters) # preproc ecg and detect peaks once
     
-    ds = xr.Dataset()
-    ds['ecg'] = ecg # store in dataset
+    times = np.arange(ecg.size) / srate # construct time vector of ECG
+
+    limits = [p['min_interval'], p['max_interval']] # define limits in bpm of heart rate
+
+    # Compute RRI signal from ecg peaks , but in bpm = heart rate
+    rri = physio.compute_instantaneous_rate(ecg_peaks = ecg_peaks, 
+                                            new_times = times,
+                                            limits = limits,
+                                            units='bpm', 
+                                            interpolation_kind=p['interpolation_kind'])
+    
+    ds = xr.Dataset(ecg_peaks.reset_index(drop=True).rename_axis('peak')) # peak table on its own dim
+    ds['ecg'] = xr.DataArray(data = ecg, dims = ['time'], coords = {'time':times})
+    ds['rri'] = xr.DataArray(data = rri, dims = ['time'], coords = {'time':times})
     ds.attrs['srate'] = srate
     
     return ds
+
+
+def test_compute_cardiac():
+    run_key = 'P05_baseline'
+    ds = compute_cardiac(run_key, **rri_signal_params)
+    print(ds)
+
+
+def compute_ecg(run_key, **p):
+    """
+    Preproc ECG (read from the cardiac stage)
+    """
+    ds_cardiac = cardiac_job.get(run_key)
+    
+    ds = xr.Dataset()
+    ds['ecg'] = ds_cardiac['ecg'].values # store in dataset
+    ds.attrs['srate'] = ds_cardiac.attrs['srate']
+    
+    return ds
     
 
 def test_compute_ecg():
@@ -44,27 +77,13 @@ def test_compute_ecg():
 # ECG PEAKS    
 def compute_ecg_peaks(run_key, **p):
     """
-    Detect ECG R peaks
+    Detect ECG R peaks (read from the cardiac stage)
     """
-    import physio
-    raw_dataset = convert_vhdr_job.get(run_key) # load
+    ds_cardiac = cardiac_job.get(run_key)
     
-    ecg_raw = raw_dataset['raw'].sel(chan='ECG', time = slice(0, p['session_duration'])).values[:-1] # sel and crop ECG to 10 mins
-    srate = raw_dataset['raw'].attrs['srate']
-
-    subject_key, ses_key = run_key.split('_')
-
-    inv = p['ecg_inversion'][subject_key]
-    ecg_raw_inv = ecg_raw * inv # reverse ECG according to dictionnary in params.py
-    
-    parameters = physio.get_ecg_parameters('human_ecg') # load physio default params
-    parameters['peak_detection']['thresh'] = p['thresh'] # change peak detection params
-    ecg, ecg_peaks = physio.compute_ecg(ecg_raw_inv, srate, parameters=parameters) # compute ecg peaks
-    
-    # fig, ax = plt.subplots()
-    # ax.plot(ecg)
-    # ax.plot(ecg_peaks['peak_index'], ecg[ecg_peaks['peak_index']], 'o')
-    # plt.show()
+    peak_vars = [v for v in ds_cardiac.data_vars if ds_cardiac[v].dims == ('peak',)]
+    ecg_peaks = ds_cardiac[peak_vars].to_dataframe()
+    ecg_peaks.index.name = None
     
     ds = xr.Dataset(ecg_peaks) # store dataframe to dataset
     return ds
@@ -78,28 +97,12 @@ def test_compute_ecg_peaks():
 # RRI VIEWER
 def compute_rri_signal(run_key, **p):
     """
-    Compute heart rate continuous signal from ECG R peaks
+    Compute heart rate continuous signal from ECG R peaks (read from the cardiac stage)
     """
-    import physio
+    ds_cardiac = cardiac_job.get(run_key)
     
-    ds_ecg = ecg_job.get(run_key) # load clean ECG
-    ecg = ds_ecg['ecg'].values
-    srate = ds_ecg.attrs['srate']
-    ecg_peaks = ecg_peak_job.get(run_key).to_dataframe() # load ECG peaks
-    
-    times = np.arange(ecg.size) / srate # construct time vector of ECG
-
-    limits = [p['min_interval'], p['max_interval']] # define limits in bpm of heart rate
-
-    # Compute RRI signal from ecg peaks , but in bpm = heart rate
-    rri = physio.compute_instantaneous_rate(ecg_peaks = ecg_peaks, 
-                                            new_times = times,
-                                            limits = limits,
-                                            units='bpm', 
-                                            interpolation_kind=p['interpolation_kind'])
-    
-    da_rri = xr.DataArray(data = rri, dims = ['time'], coords = {'time':times}) # store in dataset
-    da_rri.attrs['srate'] = srate
+    da_rri = ds_cardiac['rri'].copy()
+    da_rri.attrs['srate'] = ds_cardiac.attrs['srate']
     ds = xr.Dataset()
     ds['rri'] = da_rri
     return ds
@@ -134,12 +137,8 @@ def ecg_peaks_coupling(run_key, **p):
     ecg_peak_angles = ecg_peaks.copy() 
     ecg_peak_angles['Participant'] = sub
     ecg_peak_angles['session'] = ses
-    ecg_peak_angles['Resp_Angle'] = np.nan # ... with a respi phase angle column
-
-    for i, row in rsp_features.iterrows(): # loop on resp cycles
-        mask_r_peaks_in_cycle = (ecg_peaks['peak_time'] >= row['inspi_time']) & (ecg_peaks['peak_time'] < row['next_inspi_time']) # construct mask for selecting ECG peak times of the current resp cycle
-        r_peaks_in_cycle = ecg_peaks[mask_r_peaks_in_cycle] # apply mask
-        ecg_peak_angles.loc[r_peaks_in_cycle.index, 'Resp_Angle'] = ((r_peaks_in_cycle['peak_time'].values - row['inspi_time']) / row['cycle_duration']) # compute relative position of the ecg peak times during respitory cycle and store it at the right position in the dataframe
+    # ... with a respi phase angle column : relative position of the ecg peak times during respitory cycle (nan if out of cycles)
+    _, ecg_peak_angles['Resp_Angle'] = events_to_cycle_phase(ecg_peaks['peak_time'].values, rsp_features['inspi_time'].values, rsp_features['next_inspi_time'].values)
 
     return xr.Dataset(ecg_peak_angles) # store to dataset
 
@@ -149,19 +148,28 @@ def test_ecg_peaks_coupling():
     res = ds.to_dataframe()
     print(res)
     
-ecg_job = jobtools.Job(precomputedir, 'ecg', ecg_params, compute_ecg)
+cardiac_job = jobtools.Job(precomputedir, 'cardiac', rri_signal_params, compute_cardiac,
+                           depends_on=[(convert_vhdr_job, None)])
+jobtools.register_job(cardiac_job)
+
+ecg_job = jobtools.Job(precomputedir, 'ecg', ecg_params, compute_ecg,
+                       depends_on=[(cardiac_job, None)])
 jobtools.register_job(ecg_job)
 
-ecg_peak_job = jobtools.Job(precomputedir, 'ecg_peak', ecg_params, compute_ecg_peaks)
+ecg_peak_job = jobtools.Job(precomputedir, 'ecg_peak', ecg_params, compute_ecg_peaks,
+                            depends_on=[(cardiac_job, None)])
 jobtools.register_job(ecg_peak_job)
 
-rri_signal_job = jobtools.Job(precomputedir, 'rri_signal', rri_signal_params, compute_rri_signal)
+rri_signal_job = jobtools.Job(precomputedir, 'rri_signal', rri_signal_params, compute_rri_signal,
+                              depends_on=[(cardiac_job, None)])
 jobtools.register_job(rri_signal_job)
 
-ecg_peaks_coupling_job = jobtools.Job(precomputedir, 'ecg_peaks_coupling', ecg_params, ecg_peaks_coupling)
+ecg_peaks_coupling_job = jobtools.Job(precomputedir, 'ecg_peaks_coupling', ecg_params, ecg_peaks_coupling,
+                                      depends_on=[(ecg_peak_job, None), (respiration_features_job, None)])
 jobtools.register_job(ecg_peaks_coupling_job)
 
 def compute_all():
+    # jobtools.compute_job_list(cardiac_job, run_keys, force_recompute=False, engine='loop')
     # jobtools.compute_job_list(ecg_job, run_keys, force_recompute=False, engine='loop')
     # jobtools.compute_job_list(ecg_peak_job, run_keys, force_recompute=False, engine='loop')
     # jobtools.compute_job_list(rri_signal_job, run_keys, force_recompute=False, engine='loop')
@@ -169,6 +177,7 @@ def compute_all():
 
 
 if __name__ == '__main__':
+    # test_compute_cardiac()
     # test_compute_ecg()
     # test_compute_ecg_peaks()
     # test_compute_rri_signal()
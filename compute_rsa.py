@@ -8,9 +8,10 @@ import jobtools
 from params import *
 from configuration import *
 
-def compute_rsa_phase(run_key, **p):
+def compute_rsa(run_key, **p):
     """
-    Cyclically deform heart rate signal according to respiratory timestamps of each respiratory cycle
+    Compute heart rate dynamics cycle by cycle in a single physio pass : RSA features table and 
+    cyclically deformed heart rate according to respiratory timestamps of each respiratory cycle
     """
     resp_cycles = respiration_features_job.get(run_key).to_dataframe() # load resp features
     ecg_peaks = ecg_peak_job.get(run_key).to_dataframe() # load ecg peaks
@@ -23,12 +24,41 @@ def compute_rsa_phase(run_key, **p):
                                                          points_per_cycle=p['n_phase_bins'], # number of phase bins of the output
                                                         )
     
-    rsa_da = xr.DataArray(data = cyclic_cardiac_rate,
-                          dims = ['cycle','phase'],
-                          coords = {'cycle':np.arange(rsa_cycles.shape[0]), 'phase':np.linspace(0, 1 , p['n_phase_bins'])})
+    ds_rsa = xr.Dataset(rsa_cycles.reset_index(drop=True).rename_axis('cycle')) # RSA features table, one row by resp cycle
+    ds_rsa['rsa'] = xr.DataArray(data = cyclic_cardiac_rate,
+                                 dims = ['cycle','phase'],
+                                 coords = {'cycle':np.arange(rsa_cycles.shape[0]), 'phase':np.linspace(0, 1 , p['n_phase_bins'])})
+    return ds_rsa
+
+def test_compute_rsa():
+    run_key = 'P05_baseline'
+    ds = compute_rsa(run_key, **rsa_params)
+    print(ds)
+
+rsa_job = jobtools.Job(precomputedir, 'rsa', rsa_params, compute_rsa,
+                       depends_on=[(respiration_features_job, None), (ecg_peak_job, None)])
+jobtools.register_job(rsa_job)
+
+
+def rsa_cycles_dataframe(ds_rsa, run_key):
+    """
+    Extract the RSA features table of a run from the output of rsa_job
+    """
+    sub, ses = run_key.split('_')
+    feature_vars = [v for v in ds_rsa.data_vars if ds_rsa[v].dims == ('cycle',)]
+    rsa_cycles = ds_rsa[feature_vars].to_dataframe()
+    rsa_cycles.index.name = None
+    rsa_cycles['participant'] = sub
+    rsa_cycles['session'] = ses
+    return rsa_cycles
 
+
+def compute_rsa_phase(run_key, **p):
+    """
+    Cyclically deform heart rate signal according to respiratory timestamps of each respiratory cycle (read from rsa_job)
+    """
     ds_rsa = xr.Dataset()
-    ds_rsa['rsa'] = rsa_da
+    ds_rsa['rsa'] = rsa_job.get(run_key)['rsa']
     return ds_rsa
 
 def test_compute_rsa_phase():
@@ -36,28 +66,16 @@ def test_compute_rsa_phase():
     ds = compute_rsa_phase(run_key, **rsa_params)
     print(ds)
     
-rsa_phase_job = jobtools.Job(precomputedir, 'rsa_phase', rsa_params, compute_rsa_phase)
+rsa_phase_job = jobtools.Job(precomputedir, 'rsa_phase', rsa_params, compute_rsa_phase,
+                             depends_on=[(rsa_job, None)])
 jobtools.register_job(rsa_phase_job)
 
 
 def compute_rsa_features(run_key, **p):
     """
-    Extract Respiratory Sinus Arrhythmia features respiratory cycle by respiratory cycle
+    Extract Respiratory Sinus Arrhythmia features respiratory cycle by respiratory cycle (read from rsa_job)
     """
-    sub, ses = run_key.split('_')
-    resp_cycles = respiration_features_job.get(run_key).to_dataframe() # load resp features
-    ecg_peaks = ecg_peak_job.get(run_key).to_dataframe() # load ecg peaks
-
-    # Compute RSA features cycle by cycle
-    rsa_cycles, cyclic_cardiac_rate = physio.compute_rsa(resp_cycles,
-                                                         ecg_peaks,
-                                                         srate=10.,
-                                                         two_segment=True,
-                                                         points_per_cycle=p['n_phase_bins'],
-                                                        )
-    
-    rsa_cycles['participant'] = sub
-    rsa_cycles['session'] = ses
+    rsa_cycles = rsa_cycles_dataframe(rsa_job.get(run_key), run_key)
     
     ds_rsa_features = xr.Dataset(rsa_cycles)
     return ds_rsa_features
@@ -67,18 +85,21 @@ def test_compute_rsa_features():
     ds = compute_rsa_features(run_key, **rsa_params)
     print(ds.to_dataframe())
 
-rsa_features_job = jobtools.Job(precomputedir, 'rsa_features', rsa_params, compute_rsa_features)
+rsa_features_job = jobtools.Job(precomputedir, 'rsa_features', rsa_params, compute_rsa_features,
+                                depends_on=[(rsa_job, None)])
 jobtools.register_job(rsa_features_job)
    
    
     
 
 def compute_all():
+    # jobtools.compute_job_list(rsa_job, run_keys, force_recompute=False, engine='loop')
     # jobtools.compute_job_list(rsa_phase_job, run_keys, force_recompute=False, engine='loop')
     jobtools.compute_job_list(rsa_features_job, run_keys, force_recompute=False, engine='loop')
 
 
 if __name__ == '__main__':
+    # test_compute_rsa()
     # test_compute_rsa_phase()
     # test_compute_rsa_features()
 
@@ -8,7 +8,16 @@ import string
 import random
 import subprocess
 import inspect
+import socket
+import shutil
+import traceback
+import resource
+import datetime
+import threading
+import uuid
+from collections import OrderedDict
 
+import numpy as np
 import joblib
 import xarray as xr
 
@@ -21,6 +30,12 @@ try:
 except:
     HAVE_DASK = False
 
+try:
+    import psutil
+    HAVE_PSUTIL = True
+except:
+    HAVE_PSUTIL = False
+
 
 def register_job(job):
     global job_list
@@ -32,38 +47,572 @@ def retrieve_job(job_name):
 
 
 
-def get_path(base_folder, job_name, params):
+class KeyScopedDict(dict):
+    """
+    Parameters indexed by a key token (a participant for instance).
+    Only the entries matching the keys being computed enter the hash of a job,
+    so editing the entry of one participant does not invalidate the others.
+    """
+    pass
+
+def _contains_key_scoped(params):
+    if isinstance(params, KeyScopedDict):
+        return True
+    elif isinstance(params, dict):
+        return any(_contains_key_scoped(v) for v in params.values())
+    elif isinstance(params, list):
+        return any(_contains_key_scoped(v) for v in params)
+    return False
+
+def scope_params(params, keys):
+    """
+    Params used for the hash of keys : KeyScopedDict are reduced to the entries
+    matching a token of the keys (keys are split on '_'), or kept entirely
+    when no entry matches (concat keys for instance).
+    Plain containers are returned as is so that hashes of jobs without
+    KeyScopedDict do not change.
+    """
+    if not _contains_key_scoped(params):
+        return params
     
+    tokens = set()
+    for key in keys:
+        tokens.update(str(key).split('_'))
+    
+    if isinstance(params, KeyScopedDict):
+        scoped = {k: scope_params(v, keys) for k, v in params.items() if k in tokens}
+        if len(scoped) == 0:
+            scoped = {k: scope_params(v, keys) for k, v in params.items()}
+        return scoped
+    elif isinstance(params, dict):
+        return {k: scope_params(v, keys) for k, v in params.items()}
+    elif isinstance(params, list):
+        return [scope_params(v, keys) for v in params]
+
+
+def get_path(base_folder, job_name, params, keys=None):
+    
+    if keys is not None:
+        params = scope_params(params, keys)
     hash = joblib.hash(params)
     save_path = Path(base_folder) / job_name / hash
     
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-        with open(save_path / '__params__.json', mode='w') as f:
-            json.dump(params, f, indent=4)
+    # folders are created lazily by concurrent workers (per key hashes) : creation must not fail
+    # when another worker has just created it and the json must never be read half written
+    os.makedirs(save_path, exist_ok=True)
+    params_filename = save_path / '__params__.json'
+    if not os.path.exists(params_filename):
+        _atomic_write(_JsonStorage(), params, params_filename)
     
     return save_path
 
 
 
-def _run_one_job_task(base_folder, job_name, params, func, keys, force_recompute):
-    job = Job(base_folder, job_name, params, func)
-    job.compute(keys, force_recompute=force_recompute)
+# STORAGE BACKENDS
+# Each job persist one output per key with a storage backend (netcdf by default).
+class NetcdfStorage:
+    extension = '.nc'
+    # lazy = True means read() give a lazy dataset that must not be loaded in the get cache
+    lazy = False
+
+    def write(self, ds, filename):
+        ds.to_netcdf(filename)
+
+    def read(self, filename):
+        return xr.open_dataset(filename)
+
+
+class _JsonStorage:
+    # only used to write the __params__.json of each hash folder with _atomic_write
+    extension = '.json'
+
+    def write(self, params, filename):
+        with open(filename, mode='w') as f:
+            json.dump(params, f, indent=4)
+
+
+class ZarrStorage:
+    """
+    Chunked and compressed zarr store (one folder per key).
+    Reading is lazy so selecting a slice (ex one chan) only read the needed chunks.
+
+    chunks : dict dim name > chunk size, dims not given are not chunked
+    """
+    extension = '.zarr'
+    lazy = True
+
+    def __init__(self, chunks=None, cname='zstd', clevel=5):
+        self.chunks = chunks if chunks is not None else {}
+        self.cname = cname
+        self.clevel = clevel
+
+    @staticmethod
+    def _zarr_v3():
+        import zarr
+        return int(zarr.__version__.split('.')[0]) >= 3
+
+    def _get_encoding(self, ds):
+        import numcodecs
+        blosc = numcodecs.Blosc(cname=self.cname, clevel=self.clevel, shuffle=numcodecs.Blosc.BITSHUFFLE)
+        if self._zarr_v3():
+            compression = {'compressors': [blosc]}
+        else:
+            compression = {'compressor': blosc}
+
+        encoding = {}
+        for name, var in ds.data_vars.items():
+            var_encoding = dict(compression)
+            if var.ndim > 0 and var.dtype.kind in 'biufc':
+                var_encoding['chunks'] = tuple(min(self.chunks.get(dim, size), size) for dim, size in var.sizes.items())
+            encoding[name] = var_encoding
+        return encoding
+
+    def write(self, ds, filename):
+        # always zarr format 2 : zarr v3 format writes string coords (chan) with an unstable
+        # fixed length utf32 dtype that future zarr releases may not read back
+        kwargs = {'zarr_format': 2} if self._zarr_v3() else {}
+        ds.to_zarr(filename, mode='w', encoding=self._get_encoding(ds), **kwargs)
+
+    def read(self, filename):
+        return xr.open_zarr(filename, chunks=None)
+
+
+def _remove_output(filename):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    elif os.path.exists(filename):
+        os.remove(filename)
+
+
+# LOCK AND ATOMIC WRITE
+# A lock file is created next to the output while a key is processing, so that
+# concurrent workers (joblib, dask, slurm) never compute the same key twice.
+# The worker holding a lock refreshes its mtime every lock_heartbeat_interval (heartbeat thread).
+# A lock is considered stale when its heartbeat stopped for more than lock_stale_timeout (worker killed on any host)
+# or, on the same host, when its process is dead.
+# A stale lock is taken over by renaming it to a unique name and checking that the renamed lock is the one
+# judged stale (and not a fresh lock created in the meantime by another worker).
+lock_heartbeat_interval = 30.
+lock_stale_timeout = 300.
+lock_poll_interval = 5.
+
+def _get_lock_filename(output_filename):
+    output_filename = Path(output_filename)
+    return output_filename.parent / (output_filename.name + '.lock')
+
+def _read_lock(lock_filename):
+    try:
+        with open(lock_filename, mode='r') as f:
+            lock_info = json.load(f)
+        lock_info['mtime'] = os.stat(lock_filename).st_mtime
+    except (OSError, ValueError):
+        # lock being written or removed in the meantime
+        return None
+    return lock_info
+
+def _is_lock_stale(lock_filename, lock_info=None):
+    if lock_info is None:
+        lock_info = _read_lock(lock_filename)
+        if lock_info is None:
+            return False
+
+    if time.time() - lock_info['mtime'] > lock_stale_timeout:
+        return True
+
+    if lock_info.get('host') == socket.gethostname():
+        try:
+            os.kill(lock_info['pid'], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return False
+
+def _take_over_stale_lock(lock_filename, lock_info):
+    # rename is atomic : only one worker get the stale lock
+    lock_filename = Path(lock_filename)
+    stale_filename = lock_filename.parent / f'.{lock_filename.name}.{uuid.uuid4().hex}.stale'
+    try:
+        os.rename(lock_filename, stale_filename)
+    except FileNotFoundError:
+        # taken over by another worker
+        return True
+    renamed_info = _read_lock(stale_filename)
+    if renamed_info is not None and renamed_info.get('token') != lock_info.get('token'):
+        # a fresh lock was created between the check and the rename : give it back
+        os.rename(stale_filename, lock_filename)
+        return False
+    print('remove stale lock', lock_filename)
+    _remove_output(stale_filename)
+    return True
+
+def _acquire_lock(lock_filename):
+    # return the token of the lock or None when the lock is held by another worker
+    token = uuid.uuid4().hex
+    lock_info = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), 'token': token}
+    for _ in range(2):
+        try:
+            fd = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            other_info = _read_lock(lock_filename)
+            if other_info is not None and _is_lock_stale(lock_filename, other_info) \
+                    and _take_over_stale_lock(lock_filename, other_info):
+                continue
+            return None
+        with os.fdopen(fd, mode='w') as f:
+            json.dump(lock_info, f)
+        return token
+    return None
+
+def _release_lock(lock_filename, token=None):
+    # with a token, only remove the lock if it is still ours
+    if token is not None:
+        lock_info = _read_lock(lock_filename)
+        if lock_info is None or lock_info.get('token') != token:
+            return
+    try:
+        os.remove(lock_filename)
+    except FileNotFoundError:
+        pass
+
+class _LockHeartbeat:
+    # refresh the mtime of a held lock in a daemon thread
+    def __init__(self, lock_filename, token):
+        self.lock_filename = lock_filename
+        self.token = token
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(lock_heartbeat_interval):
+            lock_info = _read_lock(self.lock_filename)
+            if lock_info is None or lock_info.get('token') != self.token:
+                print('lost lock', self.lock_filename)
+                return
+            try:
+                os.utime(self.lock_filename)
+            except OSError:
+                pass
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+def _wait_lock(lock_filename):
+    while os.path.exists(lock_filename) and not _is_lock_stale(lock_filename):
+        time.sleep(lock_poll_interval)
+
+def _atomic_write(storage, ds, output_filename):
+    # write in a temporary file (or folder) in the same folder and then rename it
+    # so a killed worker never leave a truncated output
+    output_filename = Path(output_filename)
+    tmp_filename = output_filename.parent / f'.{output_filename.name}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        storage.write(ds, tmp_filename)
+        if os.path.isdir(output_filename):
+            # a folder can not be replaced by rename
+            old_filename = tmp_filename.parent / (tmp_filename.name + '.old')
+            os.replace(output_filename, old_filename)
+            os.replace(tmp_filename, output_filename)
+            _remove_output(old_filename)
+        else:
+            os.replace(tmp_filename, output_filename)
+    finally:
+        _remove_output(tmp_filename)
+
+
+# IN MEMORY CACHE FOR Job.get
+# Decoded datasets are kept in a LRU cache bounded in bytes, so that an upstream output read
+# by several jobs in the same process is decoded only once.
+# Entries are keyed by (job_name, params hash, keys) and are invalidated on recompute
+# or when the file on disk has changed (recomputed by another process).
+# Cached arrays are read only (shared by all the callers of Job.get) : writing in place in a get() result
+# raises instead of corrupting the cache, copy it first (ds.copy(deep=True), da.copy()).
+# The cache is per process : it is small by default and disabled in the workers of the joblib, dask and slurm engines
+# (worker_get_cache_max_bytes) so that n_jobs workers do not multiply its memory.
+class GetCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key, mtime):
+        with self._lock:
+            item = self._items.get(cache_key, None)
+            if item is not None and item[1] != mtime:
+                self._remove(cache_key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(cache_key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, cache_key, mtime, ds):
+        nbytes = ds.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if cache_key in self._items:
+                self._remove(cache_key)
+            self._items[cache_key] = (ds, mtime, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+
+    def invalidate(self, cache_key):
+        with self._lock:
+            if cache_key in self._items:
+                self._remove(cache_key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def _remove(self, cache_key):
+        ds, mtime, nbytes = self._items.pop(cache_key)
+        self.nbytes -= nbytes
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'n_items': len(self._items),
+                'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+get_cache = GetCache(max_bytes=512 * 1024 ** 2)
+worker_get_cache_max_bytes = 0
+
+def _set_read_only(ds):
+    for var in ds.variables.values():
+        if isinstance(var.data, np.ndarray):
+            var.data.flags.writeable = False
+
+def set_get_cache_size(max_bytes):
+    # max_bytes=0 disable the cache
+    get_cache.max_bytes = max_bytes
+    get_cache.clear()
+
+def get_cache_info():
+    return get_cache.info()
+
+
+# BULK READ
+# Concat jobs read many small outputs : on a high latency mount the time is dominated by opening files one by one.
+# A thread pool first reads the raw bytes of the files concurrently (plain file io, no lock) so that the decoding
+# (serialized by the netcdf/hdf5 lock of xarray) is then served from the os cache.
+def _prefetch_file(filename, block_size=4 * 1024 ** 2):
+    if os.path.isfile(filename):
+        with open(filename, mode='rb') as f:
+            while f.read(block_size):
+                pass
+
+def get_job_list(job, list_keys, n_threads=8):
+    """
+    Read the outputs of a job for a list of keys with a thread pool (prefetching the files).
+    Return the list of datasets in the order of list_keys.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _get(keys):
+        keys = job._make_keys(keys)
+        _prefetch_file(job.get_filename(keys))
+        return job.get(keys)
+
+    if n_threads <= 1:
+        return [_get(keys) for keys in list_keys]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(_get, list_keys))
+
+
+# RUN LEDGER
+# Each Job.compute call append one line to base_folder/__ledger__.jsonl with timing, memory and io measurements.
+ledger_enabled = True
+ledger_filename = '__ledger__.jsonl'
+
+# Peak rss and read bytes are process wide : they are only reset and measured by the outermost compute
+# of the process. A compute started while another one is running (upstream computed inline by Job.get, 
+# or get_job_list threads) is recorded with nested=True and without peak_rss/read_bytes, which are
+# included in the outer entry.
+_compute_depth = 0
+_compute_depth_lock = threading.Lock()
+
+def _enter_compute():
+    global _compute_depth
+    with _compute_depth_lock:
+        outermost = _compute_depth == 0
+        _compute_depth += 1
+    return outermost
+
+def _exit_compute():
+    global _compute_depth
+    with _compute_depth_lock:
+        _compute_depth -= 1
+
+def _reset_peak_rss():
+    # linux only : reset the VmHWM of the process so that the peak is the one of the current compute
+    try:
+        with open('/proc/self/clear_refs', mode='w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _get_peak_rss():
+    try:
+        with open('/proc/self/status', mode='r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # fallback = peak of the whole process life (kB on linux, bytes on mac)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _get_read_bytes():
+    if HAVE_PSUTIL:
+        try:
+            io = psutil.Process().io_counters()
+            return getattr(io, 'read_chars', io.read_bytes)
+        except (psutil.Error, AttributeError):
+            return None
+    try:
+        with open('/proc/self/io', mode='r') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _get_output_size(filename):
+    if os.path.isdir(filename):
+        return sum(f.stat().st_size for f in Path(filename).rglob('*') if f.is_file())
+    elif os.path.exists(filename):
+        return os.path.getsize(filename)
+    return 0
+
+def _write_ledger_entry(base_folder, entry):
+    if not ledger_enabled:
+        return
+    try:
+        with open(Path(base_folder) / ledger_filename, mode='a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError:
+        print('erreur write ledger', entry['job_name'], entry['keys'])
+
+def read_ledger(base_folder, job_name=None):
+    """
+    Read the run ledger as a pd.DataFrame (one row per Job.compute call)
+    """
+    import pandas as pd
+    filename = Path(base_folder) / ledger_filename
+    rows = []
+    if os.path.exists(filename):
+        with open(filename, mode='r') as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    # line truncated by a killed process
+                    pass
+    ledger = pd.DataFrame(rows)
+    if job_name is not None and ledger.shape[0] > 0:
+        ledger = ledger[ledger['job_name'] == job_name].reset_index(drop=True)
+    return ledger
+
+def ledger_report(base_folder, job_name=None):
+    """
+    Summary by job of the run ledger, sorted by total wall time
+    """
+    ledger = read_ledger(base_folder, job_name=job_name)
+    if ledger.shape[0] == 0:
+        return ledger
+    ledger['failed'] = ~ledger['success']
+    report = ledger.groupby('job_name').agg(n_runs=('keys', 'size'),
+                                           n_failed=('failed', 'sum'),
+                                           total_wall_time=('wall_time', 'sum'),
+                                           mean_wall_time=('wall_time', 'mean'),
+                                           max_wall_time=('wall_time', 'max'),
+                                           mean_cpu_time=('cpu_time', 'mean'),
+                                           max_peak_rss=('peak_rss', 'max'),
+                                           total_read_bytes=('read_bytes', 'sum'),
+                                           total_written_bytes=('written_bytes', 'sum'),
+                                          )
+    report = report.sort_values(by='total_wall_time', ascending=False)
+    return report
+
+def suggest_slurm_params(base_folder, job_name, mem_margin=1.5):
+    """
+    Suggest slurm_params (cpus-per-task and mem) for a job from the measured successful runs
+    """
+    import math
+    ledger = read_ledger(base_folder, job_name=job_name)
+    if ledger.shape[0] == 0:
+        raise ValueError(f'no run in ledger for {job_name}')
+    ledger = ledger[ledger['success']]
+    if ledger.shape[0] == 0:
+        raise ValueError(f'no successful run in ledger for {job_name}')
+    cpus = max(1, math.ceil((ledger['cpu_time'] / ledger['wall_time']).quantile(0.9)))
+    # nested runs have no peak_rss of their own (measured by the outer compute)
+    peak_rss = ledger['peak_rss'].dropna()
+    if peak_rss.size == 0:
+        raise ValueError(f'no outermost run in ledger for {job_name} (only computed inline by downstream jobs)')
+    mem_gb = max(1, math.ceil(peak_rss.max() * mem_margin / 1024 ** 3))
+    return {'cpus-per-task': str(cpus), 'mem': f'{mem_gb}G'}
+
+
+def _run_one_job_task(base_folder, job_name, params, func, keys, force_recompute, job_kargs=None, engine=None):
+    if job_kargs is None:
+        job_kargs = {}
+    if get_cache.max_bytes != worker_get_cache_max_bytes:
+        set_get_cache_size(worker_get_cache_max_bytes)
+    job = Job(base_folder, job_name, params, func, **job_kargs)
+    job.compute(keys, force_recompute=force_recompute, engine=engine)
+
+
+def _run_one_graph_task(base_folder, job_name, params, func, keys, force_recompute, job_kargs=None, upstream_tasks=None):
+    # upstream_tasks is only here to make dask wait for the upstream nodes
+    _run_one_job_task(base_folder, job_name, params, func, keys, force_recompute, job_kargs=job_kargs, engine='dask')
 
 
 _slurm_script = """#! {python}
 import sys
 sys.path.append("{module_folder}")
+import jobtools
 from jobtools import _run_one_job_task
 
 from {module_name} import {job_instance_name} as job
 
-job.compute({keys}, force_recompute={force_recompute})
+jobtools.set_get_cache_size(jobtools.worker_get_cache_max_bytes)
+job.compute({keys}, force_recompute={force_recompute}, engine='slurm')
 """
 
 
-def compute_job_list(job, list_keys, force_recompute=True, engine='loop', **engine_kargs):
+def _dedup_group_keys(job, list_keys):
+    # keep the first keys of each group
+    task_keys_done = set()
+    deduped = []
+    for keys in list_keys:
+        task_keys = job.get_task_keys(keys)
+        if task_keys not in task_keys_done:
+            task_keys_done.add(task_keys)
+            deduped.append(keys)
+    return deduped
+
+
+def compute_job_list(job, list_keys, force_recompute=True, engine='loop', with_dependencies=False, **engine_kargs):
     
+    if with_dependencies:
+        compute_job_graph(job, list_keys, force_recompute=force_recompute, engine=engine, **engine_kargs)
+        return
+
     if not force_recompute:
         cleaned_list_key = []
         #clean the list
@@ -75,11 +624,14 @@ def compute_job_list(job, list_keys, force_recompute=True, engine='loop', **engi
                 print(job.job_name , 'already processed',keys)
         list_keys = cleaned_list_key
 
+    if job.group_keys is not None:
+        # one task per group : it computes all the outputs of the group
+        list_keys = _dedup_group_keys(job, list_keys)
     
     t0 = time.perf_counter()
     if engine == 'loop':
         for keys in list_keys:
-            job.compute(keys, force_recompute=force_recompute)
+            job.compute(keys, force_recompute=force_recompute, engine='loop')
     elif engine == 'dask':
         #~ raise(NotImplementedError)
         #~ 
@@ -88,7 +640,8 @@ def compute_job_list(job, list_keys, force_recompute=True, engine='loop', **engi
         tasks = []
         for keys in list_keys:
             #~ print('submit', keys)
-            task = client.submit(_run_one_job_task, job.base_folder, job.job_name, job.params, job.func, keys, force_recompute)
+            task = client.submit(_run_one_job_task, job.base_folder, job.job_name, job.params, job.func, keys, force_recompute,
+                                 job_kargs=job.get_task_kargs(), engine='dask')
             tasks.append(task)
         
         for task in tasks:
@@ -99,7 +652,7 @@ def compute_job_list(job, list_keys, force_recompute=True, engine='loop', **engi
         #~ joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(job.compute)(keys) for keys in list_keys)
         #~ print(job.base_folder, job.job_name, job.params, job.func, list_keys[0])
         joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(_run_one_job_task)(job.base_folder,
-            job.job_name, job.params, job.func, keys, force_recompute) for keys in list_keys)
+            job.job_name, job.params, job.func, keys, force_recompute, job_kargs=job.get_task_kargs(), engine='joblib') for keys in list_keys)
     
     elif engine == 'slurm':
         # # create python script and launch then with "srun"
@@ -203,13 +756,189 @@ def compute_job_list(job, list_keys, force_recompute=True, engine='loop', **engi
 
 
 
+def _outputs_done(job, keys):
+    # a group job is done only when all the outputs of the group are on disk
+    # (a crash in the middle of the save leaves a partial group)
+    return all(os.path.exists(job.get_filename(*out_keys)) for out_keys in job.get_output_keys(*keys))
+
+def resolve_job_graph(job, list_keys, force_recompute=False):
+    """
+    Resolve the dependency graph of (job, keys) nodes needed to compute job over list_keys.
+
+    Upstream nodes are only included when their output is not already on disk,
+    force_recompute only applies to the target job.
+
+    Returns a list of levels, each level is a list of (job, keys) that can be computed
+    concurrently once all the previous levels are done.
+    """
+    depth = {}
+    nodes = {}
+
+    def visit(node_job, keys, is_target, stack):
+        # a group job is one node per group whatever the keys
+        node_id = (node_job.job_name, node_job.get_task_keys(keys))
+        if node_id in depth:
+            return depth[node_id]
+        if node_id in stack:
+            raise ValueError(f'circular dependency on {node_job.job_name} {keys}')
+
+        if not is_target or not force_recompute:
+            if _outputs_done(node_job, keys):
+                # already done : no need to go upstream
+                return -1
+
+        d = 0
+        for upstream_job, upstream_keys in node_job.get_upstream_keys(*keys):
+            d_up = visit(upstream_job, upstream_keys, False, stack | {node_id})
+            d = max(d, d_up + 1)
+
+        depth[node_id] = d
+        nodes[node_id] = (node_job, keys)
+        return d
+
+    for keys in list_keys:
+        visit(job, job._make_keys(keys), True, frozenset())
+
+    n_levels = max(depth.values()) + 1 if len(depth) > 0 else 0
+    levels = [[] for _ in range(n_levels)]
+    for node_id, d in depth.items():
+        levels[d].append(nodes[node_id])
+    return levels
+
+
+def compute_job_graph(job, list_keys, force_recompute=False, engine='loop', **engine_kargs):
+    """
+    Compute job over list_keys and, before that, all the missing upstream outputs
+    declared with depends_on/add_dependency.
+
+    Nodes of the same level are independent and are run concurrently with
+    the 'joblib' or 'dask' engine. A node whose upstream failed is skipped.
+    """
+    levels = resolve_job_graph(job, list_keys, force_recompute=force_recompute)
+    n_nodes = sum(len(level) for level in levels)
+    print(job.job_name, 'graph :', n_nodes, 'nodes in', len(levels), 'levels')
+
+    t0 = time.perf_counter()
+
+    failed = set()
+    tasks = {}
+    for level in levels:
+        level_todo = []
+        for node_job, keys in level:
+            upstream_ids = [(up_job.job_name, up_job.get_task_keys(up_keys)) for up_job, up_keys in node_job.get_upstream_keys(*keys)]
+            if any(node_id in failed for node_id in upstream_ids):
+                print(node_job.job_name, 'skipped because of upstream failure', keys)
+                failed.add((node_job.job_name, node_job.get_task_keys(keys)))
+                continue
+            level_todo.append((node_job, keys, upstream_ids))
+
+        # force_recompute only concern the target
+        node_force = lambda node_job: force_recompute and node_job is job
+
+        if engine == 'loop':
+            for node_job, keys, _ in level_todo:
+                node_job.compute(keys, force_recompute=node_force(node_job), engine='loop')
+
+        elif engine == 'joblib':
+            n_jobs = engine_kargs['n_jobs']
+            joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(_run_one_job_task)(node_job.base_folder,
+                node_job.job_name, node_job.params, node_job.func, keys, node_force(node_job),
+                job_kargs=node_job.get_task_kargs(), engine='joblib')
+                for node_job, keys, _ in level_todo)
+
+        elif engine == 'dask':
+            # dask already handles dependencies : submit everything, upstream futures are passed as args
+            client = engine_kargs['client']
+            for node_job, keys, upstream_ids in level_todo:
+                upstream_tasks = [tasks[node_id] for node_id in upstream_ids if node_id in tasks]
+                task = client.submit(_run_one_graph_task, node_job.base_folder, node_job.job_name,
+                                     node_job.params, node_job.func, keys, node_force(node_job),
+                                     job_kargs=node_job.get_task_kargs(), upstream_tasks=upstream_tasks)
+                tasks[(node_job.job_name, node_job.get_task_keys(keys))] = task
+
+        else:
+            raise ValueError(f'engine not supported for graph {engine}')
+
+        if engine != 'dask':
+            for node_job, keys, _ in level_todo:
+                # maybe processed by another worker
+                _wait_lock(node_job.get_lock_filename(keys))
+                if not _outputs_done(node_job, keys):
+                    failed.add((node_job.job_name, node_job.get_task_keys(keys)))
+
+    if engine == 'dask':
+        for task in tasks.values():
+            task.result()
+
+    t1 = time.perf_counter()
+    print(job.job_name, 'Total graph time {:.3f}'.format(t1-t0))
+
+
+
 class Job:
-    def __init__(self, base_folder, job_name, params, func):
+    def __init__(self, base_folder, job_name, params, func, depends_on=None, storage=None,
+                 group_keys=None, group_members=None):
         self.base_folder = base_folder
         self.job_name = job_name
         self.params = params
-        self.save_path = get_path(base_folder, job_name, params)
+        # with KeyScopedDict in params the hash (and so the folder) depends on keys
+        self.key_scoped = _contains_key_scoped(params)
+        if self.key_scoped:
+            self.save_path = None
+            self._save_paths = {}
+        else:
+            self.save_path = get_path(base_folder, job_name, params)
         self.func = func
+        self.storage = storage if storage is not None else NetcdfStorage()
+        
+        # multi output mode : func(*group_keys, **params) computes all the outputs of a group in one task
+        # and returns a dict {keys: ds}, group_keys(*keys) give the group of keys
+        # and group_members(*group_keys) the list of keys of the group
+        assert (group_keys is None) == (group_members is None), 'group_keys and group_members go together'
+        self.group_keys = group_keys
+        self.group_members = group_members
+        
+        # list of (upstream_job, key_mapper)
+        # key_mapper(*keys) give the upstream keys (or a list of upstream keys), None = same keys
+        self.depends_on = []
+        if depends_on is not None:
+            for upstream_job, key_mapper in depends_on:
+                self.add_dependency(upstream_job, key_mapper)
+    
+    def add_dependency(self, upstream_job, key_mapper=None):
+        self.depends_on.append((upstream_job, key_mapper))
+    
+    def get_task_kargs(self):
+        # options needed to rebuild the job in a worker
+        return {'storage': self.storage, 'group_keys': self.group_keys, 'group_members': self.group_members}
+    
+    def get_task_keys(self, *args):
+        # keys of the task that computes these keys : the group keys in multi output mode
+        keys = self._make_keys(*args)
+        if self.group_keys is None:
+            return keys
+        return self._make_keys(self.group_keys(*keys))
+    
+    def get_output_keys(self, *args):
+        # all the keys computed by the task that computes these keys
+        keys = self._make_keys(*args)
+        if self.group_keys is None:
+            return [keys]
+        return [self._make_keys(member) for member in self.group_members(*self.get_task_keys(keys))]
+    
+    def get_upstream_keys(self, *args):
+        keys = self._make_keys(*args)
+        upstream = []
+        for upstream_job, key_mapper in self.depends_on:
+            if key_mapper is None:
+                upstream_keys = [keys]
+            else:
+                upstream_keys = key_mapper(*keys)
+                if not isinstance(upstream_keys, list):
+                    upstream_keys = [upstream_keys]
+            for up_keys in upstream_keys:
+                upstream.append((upstream_job, upstream_job._make_keys(up_keys)))
+        return upstream
     
     def _make_keys(self, *args):
         if len(args) == 1:
@@ -228,41 +957,153 @@ class Job:
             raise(ValueError('need keys'))
         return keys
     
+    def get_save_path(self, *args):
+        if not self.key_scoped:
+            return self.save_path
+        keys = self._make_keys(*args)
+        if keys not in self._save_paths:
+            self._save_paths[keys] = get_path(self.base_folder, self.job_name, self.params, keys=keys)
+        return self._save_paths[keys]
+    
     def get_filename(self, *args):
         keys = self._make_keys(*args)
-        filename = self.save_path / ('_'.join(keys) + '.nc')
+        filename = self.get_save_path(keys) / ('_'.join(keys) + self.storage.extension)
         return filename
         
+    def get_lock_filename(self, *args):
+        keys = self._make_keys(*args)
+        if self.group_keys is None:
+            return _get_lock_filename(self.get_filename(keys))
+        # one lock for the whole group
+        task_keys = self.get_task_keys(keys)
+        return self.get_save_path(keys) / ('_'.join(task_keys) + '.group.lock')
+        
+    def _get_cache_key(self, keys):
+        return (self.job_name, self.get_save_path(keys).name, keys)
+        
     def get(self, *args, compute=False):
+        keys = self._make_keys(*args)
         filename = self.get_filename(*args)
-        if not filename.is_file() or compute:
+        if not filename.exists() or compute:
             ds = self.compute(*args)
-            return ds
-        ds = xr.open_dataset(filename)
+            if ds is not None:
+                return ds
+            # computed by another worker in the meantime
+            _wait_lock(self.get_lock_filename(keys))
+            if not filename.exists():
+                return None
+        
+        if self.storage.lazy:
+            return self.storage.read(filename)
+        
+        cache_key = self._get_cache_key(keys)
+        mtime = os.stat(filename).st_mtime_ns
+        ds = get_cache.get(cache_key, mtime)
+        if ds is not None:
+            # shallow copy so that the caller can add/remove variables without touching the cache
+            # (arrays are read only, see _set_read_only)
+            return ds.copy(deep=False)
+        
+        ds = self.storage.read(filename)
+        if ds.nbytes <= get_cache.max_bytes:
+            ds.load()
+            ds.close()
+            _set_read_only(ds)
+            get_cache.put(cache_key, mtime, ds)
+            ds = ds.copy(deep=False)
         return ds
     
-    def compute(self, *args, force_recompute=False):
+    def compute(self, *args, force_recompute=False, engine=None):
         keys = self._make_keys(*args)
-        output_filename = self.get_filename(*args)
-        if not force_recompute and os.path.exists(output_filename):
+        task_keys = self.get_task_keys(keys)
+        output_keys = self.get_output_keys(keys)
+        output_filenames = [self.get_filename(k) for k in output_keys]
+        if not force_recompute and all(os.path.exists(f) for f in output_filenames):
             print(self.job_name , 'already processed',keys)
             return
         
-        print(self.job_name, 'is processing' , keys)
-        try:
-            ds = self.func(*keys, **self.params)
-        except:
-            print('Erreur processing', self.job_name, keys)
+        lock_filename = self.get_lock_filename(keys)
+        lock_token = _acquire_lock(lock_filename)
+        if lock_token is None:
+            print(self.job_name, 'is processing in another worker', task_keys)
             return None
+        heartbeat = _LockHeartbeat(lock_filename, lock_token)
+        heartbeat.start()
         
-        if ds is not None:
-            try :
-                ds.to_netcdf(output_filename)
-            except PermissionError:
-                # 2 job are computed in parralel
-                pass
-                print('erreur write')
-
+        try:
+            if not force_recompute and all(os.path.exists(f) for f in output_filenames):
+                # done by another worker between the check and the lock
+                print(self.job_name , 'already processed',keys)
+                return
+            
+            print(self.job_name, 'is processing' , task_keys)
+            entry = {'job_name': self.job_name, 'params_hash': self.get_save_path(keys).name, 'keys': list(task_keys),
+                     'start': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'host': socket.gethostname(), 'pid': os.getpid(),
+                     # engine=None : computed inline by a Job.get of a downstream job
+                     'engine': engine if engine is not None else 'get',
+                     'n_outputs': len(output_keys),
+                     'success': True, 'exception': None}
+            outermost = _enter_compute()
+            entry['nested'] = not outermost
+            try:
+                if outermost:
+                    _reset_peak_rss()
+                    read_bytes0 = _get_read_bytes()
+                t0 = time.perf_counter()
+                cpu0 = time.process_time()
+                
+                try:
+                    result = self.func(*task_keys, **self.params)
+                except:
+                    print('Erreur processing', self.job_name, task_keys)
+                    result = None
+                    entry['success'] = False
+                    entry['exception'] = traceback.format_exc()
+                
+                entry['wall_time'] = time.perf_counter() - t0
+                entry['cpu_time'] = time.process_time() - cpu0
+                if outermost:
+                    entry['peak_rss'] = _get_peak_rss()
+                    read_bytes1 = _get_read_bytes()
+                    entry['read_bytes'] = read_bytes1 - read_bytes0 if read_bytes0 is not None else None
+                else:
+                    entry['peak_rss'] = None
+                    entry['read_bytes'] = None
+            finally:
+                _exit_compute()
+            
+            if self.group_keys is None:
+                outputs = {keys: result}
+            elif result is None:
+                outputs = {}
+            else:
+                outputs = {self._make_keys(k): ds for k, ds in result.items()}
+            
+            written_bytes = 0
+            for out_keys, output_filename in zip(output_keys, output_filenames):
+                out_ds = outputs.get(out_keys, None)
+                if out_ds is None:
+                    if entry['success'] and self.group_keys is not None:
+                        print('Erreur missing output', self.job_name, out_keys)
+                        entry['success'] = False
+                    continue
+                if not force_recompute and out_keys != keys and os.path.exists(output_filename):
+                    # other output of the group already done
+                    continue
+                try :
+                    _atomic_write(self.storage, out_ds, output_filename)
+                except OSError:
+                    print('erreur write', self.job_name, out_keys)
+                    entry['success'] = False
+                    entry['exception'] = traceback.format_exc()
+                written_bytes += _get_output_size(output_filename)
+            entry['written_bytes'] = written_bytes
+            _write_ledger_entry(self.base_folder, entry)
+        finally:
+            for out_keys in output_keys:
+                get_cache.invalidate(self._get_cache_key(out_keys))
+            heartbeat.stop()
+            _release_lock(lock_filename, lock_token)
         
-        return ds
-
+        return outputs.get(keys, None)
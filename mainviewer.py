@@ -13,6 +13,7 @@ from params import eeg_chans, session_duration
 from preproc import convert_vhdr_job, preproc_job, artifact_job, eeg_interp_artifact_job
 from compute_resp_features import respiration_features_job
 from compute_rri import ecg_job, rri_signal_job, ecg_peak_job
+from bibliotheque_artifact_detection import merge_intervals
 
 
 
@@ -103,10 +104,11 @@ def get_viewer_from_run_key(run_key, parent=None):
 
     # VIEWER ARTIFACT EPOCHS
     artifacts = artifact_job.get(run_key).to_dataframe()
+    starts, stops = merge_intervals(artifacts['start_t'].values, artifacts['stop_t'].values) # sorted disjoint epochs
     d = {
-        'time' : artifacts['start_t'].values,
-        'duration' : artifacts['duration'].values,
-        'label': np.full(shape = artifacts.shape[0], fill_value='artifact'),
+        'time' : starts,
+        'duration' : stops - starts,
+        'label': np.full(shape = starts.size, fill_value='artifact'),
         'name': 'Artifact eeg epoch',
     }
     periods.append(d)
@@ -1,6 +1,7 @@
 # RUN KEYS
 
 from configuration import data_path
+from jobtools import KeyScopedDict # dicts by participant : only the entry of the computed participant enters the hash of jobs
 
 subject_keys = ['P01','P02','P03','P04','P05',
                 'P06','P07','P08','P09','P10',
@@ -133,7 +134,7 @@ all_chans = ['Fp1', 'Fz', 'F3', 'F7', 'FT9', 'FC5', 'FC1', 'C3', 'T7', 'TP9',
              'CP6','CP2', 'C4', 'T8', 'FT10', 'FC6', 'FC2', 'F4', 'F8', 'Fp2',
              'ECG','RespiNasale','RespiVentrale','GSR','FCI']
 
-participants_label = {
+participants_label = KeyScopedDict({
     'P01':'DB01', # OK
     'P02':'FB02', # OK
     'P03':'ZB03', # OK
@@ -165,7 +166,7 @@ participants_label = {
     'P29':'ML29', # OK
     'P30':'EG30', # OK
     'P31':'MG31' # OK
-    }
+    })
 
 
 session_duration = 600.
@@ -184,7 +185,7 @@ fbands = {
     'very_high_gamma':[100,200],
     }
 
-ecg_inversion = { 
+ecg_inversion = KeyScopedDict({ 
 'P01':1, # OK
 'P02':1, # OK
 'P03':-1, # OK
@@ -216,7 +217,7 @@ ecg_inversion = {
 'P29':-1, # OK
 'P30':-1, # OK
 'P31':-1 # OK        
-}
+})
 
 
 
@@ -224,7 +225,7 @@ ecg_inversion = {
 n_components_decomposition = 10
 
 # components exclusion
-ica_excluded_component = {
+ica_excluded_component = KeyScopedDict({
 'P01':{'baseline':[0,1],'music':[0,1],'odor':[0,1]}, # OK
 'P02':{'baseline':[0,1],'music':[0,3],'odor':[0,2]}, # OK
 'P03':{'baseline':[0,2],'music':[0,1],'odor':[1,3]}, # OK
@@ -256,7 +257,7 @@ ica_excluded_component = {
 'P29':{'baseline':[2],'music':[2],'odor':[1]}, # OK
 'P30':{'baseline':[0,1],'music':[0,1],'odor':[0,1]}, # OK
 'P31':{'baseline':[0,2],'music':[0,2],'odor':[0,2]} # OK
-}
+})
 
 bio_filters = {
     'ECG':{'low':5,'high':45, 'ftype':'bessel', 'order':5} , 
@@ -280,16 +281,26 @@ random_state = 27
 notch_freqs = np.arange(50, 200, 50).tolist()
 n_components_decomposition = 10
 
+ica_fit_params = { # ICA is fitted once per run, the exclusion of components is done by preproc
+    'participants_label': participants_label,
+    'session_duration':session_duration,
+    'reref':reref,
+    'ica_highpass':1, # highpass frequency in Hz of the signal on which ICA is fitted
+    'method':'fastica',
+    'random_state' : random_state,
+    'n_components_decomposition' : n_components_decomposition,
+}
+
 ica_figure_params = {
      'random_state' : random_state,
      'notch_freqs' : notch_freqs,
      'n_components_decomposition' : n_components_decomposition,
+     'ica_fit_params':ica_fit_params,
 }
 
 preproc_params = {
     'participants_label': participants_label,
     'notch_freqs' : notch_freqs,
-    'save_ica_fig': True,
     'random_state' : random_state,
     'ica_excluded_component': ica_excluded_component,
     # 'eeg_chans': eeg_chans ,
@@ -299,9 +310,14 @@ preproc_params = {
     'highcut':200, # highcut frequency in Hz
     'ftype':'butter',
     'order':6,
-    'reref':reref
+    'reref':reref,
+    'ica_fit_params':ica_fit_params, # decomposition applied by preproc (fitted by ica_fit_job)
 }
 
+# duration in seconds of chunks for in place detrend + filtering in compute_preproc (None = full signal at once)
+# not in preproc_params because it does not change outputs
+preproc_chunk_duration = 60.
+
 artifact_params = {
     'preproc_params':preproc_params,
     'n_deviations':3, # number of deviations (MAD) to the median
@@ -321,6 +337,11 @@ artifact_by_chan_params = {
     'hf':150, # high cutoff frequency to filter signal on which artifacts are detected
 }
 
+artifact_detection_params = { # filtering and RMS computed once for both detections
+    'artifact_params':artifact_params,
+    'artifact_by_chan_params':artifact_by_chan_params,
+}
+
 interp_artifact_params = {
     'artifact_params':artifact_params,
     'freq_min':30., # lowcut of frequency band to compute average power of whole signal to colour white noise before inserting in artifacted zones
@@ -334,9 +355,25 @@ count_artifact_params = {
     'thresh_prop_time_artifacted':0.3 # trials with more than this proportion of time artifacted will be marked as removable
 }
 
-respiration_features_params = {
+# Welch windowing shared by the EEG spectra and the resp spectra they are compared to (same frequency grids)
+psd_lowest_freq = 0.1 # lowest frequency interpretable in PSD = at least 5 cycles of this frequency in each Hann window
+coherence_lowest_freq = 0.15 # lowest frequency interpretable in coherence = at least n_cycles cycles of this frequency in each window
+coherence_nfft_factor = 2 # zero padding = window length * nfft_factor
+coherence_n_cycles = 4 # at least 'n_cycles' cycles of lowest frequency in each window
+
+respiration_params = {
     'inspiration_sign' : '+',
-    'session_duration':session_duration
+    'session_duration':session_duration,
+    'resp_chan':'RespiNasale',
+    'spectrum_params':{ # welch spectra of the preprocessed resp signal, each one on the frequency grid of the eeg spectra it is compared to
+        'psd':{'lowest_freq':psd_lowest_freq}, # same windowing as psd_params (power_at_resp_job)
+        'coherence':{'lowest_freq':coherence_lowest_freq, 'nfft_factor':coherence_nfft_factor, 'n_cycles':coherence_n_cycles}, # same windowing as coherence_params (coherence_at_resp_job)
+    },
+    'fmax_search_max':1, # dominant respiratory frequency is searched below this frequency (Hz)
+}
+
+respiration_features_params = {
+    'respiration_params':respiration_params
 }
 
 
@@ -356,7 +393,7 @@ rri_signal_params = {
 
 psd_params = {
     'interp_artifact_params':interp_artifact_params,
-    'lowest_freq':0.1, # lowest frequency interpretable in PSD = at least 5 cycles of this frequency in each Hann window
+    'lowest_freq':psd_lowest_freq, # lowest frequency interpretable in PSD = at least 5 cycles of this frequency in each Hann window
 }
 
 psd_bandpower_params = {
@@ -364,6 +401,11 @@ psd_bandpower_params = {
     'lowest_freq':1, # lowest frequency interpretable in PSD = at least 5 cycles of this frequency in each Hann window
 }
 
+psd_resolutions_params = {
+    'psd_params':psd_params,
+    'psd_bandpower_params':psd_bandpower_params,
+}
+
 psd_baselined_params = {
 'psd_bandpower_params':psd_bandpower_params}
 
@@ -371,27 +413,26 @@ bandpower_params = {
     'psd_baselined_params':psd_baselined_params,
     'fbands':fbands,
     'total_band':[psd_bandpower_params['lowest_freq'] , 200], # keep clean freq band (> 200 Hz = noisy)
+    'total_power':'integral', # relative power = band integral / integral of psd over total_band (was the value of the single total_band[0] bin)
 }
 
 power_at_resp_params = {
     'psd_params':psd_params,
-    'session_duration':session_duration,
-    'resp_chan':'RespiNasale',
-    'lowest_freq_psd_resp':0.1, # lowest frequency interpretable in PSD = at least 5 cycles of this frequency in each Hann window
+    'respiration_params':respiration_params,
+    'resp_spectrum':'psd', # key of respiration_params['spectrum_params'] sharing the frequency grid of psd_eeg_job
 }
 
 coherence_params = {
     'interp_artifact_params':interp_artifact_params,
-    'resp_chan':'RespiNasale',
-    'lowest_freq_psd_resp':0.15, # lowest frequency interpretable in coherence = at least 5 cycles of this frequency in each window
-    'lowest_freq_coherence':0.15, # lowest frequency interpretable in coherence = at least 5 cycles of this frequency in each window
-    'nfft_factor':2, # zero padding = window length * nfft_factor
-    'n_cycles':4, # at least 'n_cycles' cycles of lowest frequency in each window
-    'session_duration':session_duration
+    'respiration_params':respiration_params,
+    'lowest_freq_coherence':coherence_lowest_freq, # lowest frequency interpretable in coherence = at least n_cycles cycles of this frequency in each window
+    'nfft_factor':coherence_nfft_factor, # zero padding = window length * nfft_factor
+    'n_cycles':coherence_n_cycles, # at least 'n_cycles' cycles of lowest frequency in each window
 }
 
 coherence_at_resp_params = {
     'coherence_params': coherence_params,
+    'resp_spectrum':'coherence', # key of respiration_params['spectrum_params'] sharing the frequency grid of coherence_job
 }
 
 power_params = {
@@ -403,7 +444,8 @@ power_params = {
     'f_stop':150, # highest frequency of time-frequency maps (logarithm increase before)
     'c_start':10, # start number of oscillations of wavelets (for the f_start, logarithmically increasing)
     'c_stop':30, # stop number of oscillations of wavelets (for the f_stop, logarithmically increasing)
-    'amplitude_exponent':2 # exponent to transform amplitude into power
+    'amplitude_exponent':2, # exponent to transform amplitude into power
+    'tf_dtype':'complex64', # precision of time frequency computation ('complex64' = single precision, power stored in float32, or 'complex128')
 }
 
 baseline_params = {'power_params':power_params}
@@ -418,6 +460,14 @@ phase_freq_params = {
     'compress_cycle_modes':[0.1,0.2,0.25,0.3,0.4,0.5,0.6,0.7,0.75,0.8,0.9,10] # 10 = 'mean', rest = quantiles
 }
 
+phase_freq_deform_params = { # cyclical deformation operator on the time base of power maps
+    'respiration_features_params':respiration_features_params,
+    'srate':srate / power_params['decimate_factor'], # sampling rate of power maps
+    'n_times':int(np.ceil(session_duration * srate / power_params['decimate_factor'])), # number of time points of power maps
+    'n_phase_bins':phase_freq_params['n_phase_bins'],
+    'segment_ratios':phase_freq_params['segment_ratios'],
+}
+
 phase_freq_concat_params = {
     'sub_keys':subject_keys,
     'ses_keys':session_keys,
@@ -446,7 +496,8 @@ erp_time_freq_params = {
     'baseline_params':baseline_params,
     'power_params':power_params,
     'half_window_duration':5, # half size of windows in seconds
-    'compress_cycle_mode':0.75 # quantile to compress cycle axis
+    'compress_cycle_mode':0.75, # quantile to compress cycle axis
+    'edge_epochs':'drop', # windows overlapping session edges are dropped (were wrapped around before)
 }
 
 erp_time_freq_concat_params = {
@@ -563,6 +614,14 @@ cycle_signal_params = {
     'session_duration':session_duration
 }
 
+cycle_signal_deform_params = { # cyclical deformation operator on the time base of EEG signals
+    'respiration_features_params':respiration_features_params,
+    'srate':srate,
+    'n_times':int(session_duration * srate), # number of time points of EEG signals
+    'n_phase_bins':cycle_signal_params['n_phase_bins'],
+    'segment_ratios':cycle_signal_params['segment_ratios'],
+}
+
 cycle_signal_modulation_params = {
     'cycle_signal_params':cycle_signal_params,
 }
@@ -574,8 +633,13 @@ erp_signal_params = {
     'session_duration':session_duration,
     'window_size_secs':10,
     'start_window_size_before_transition_secs':5,
+    'edge_epochs':'drop', # windows overlapping session edges are dropped (were zero rows before)
 }
 
+# number of channels epoched at once in erp_signal (bounds the memory of the event * chan * time epochs)
+# not in erp_signal_params because it does not change outputs
+erp_signal_chan_block_size = 8
+
 concat_erp_signal_params = {
     'erp_signal_params':erp_signal_params
 }
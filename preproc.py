@@ -4,10 +4,10 @@ import xarray as xr
 from bibliotheque import mne_to_xarray
 import pandas as pd
 import jobtools
-from bibliotheque import get_raw_mne
+from bibliotheque import get_raw_mne, chunked_detrend, chunked_sosfiltfilt, ica_to_xarray, xarray_to_ica
 import matplotlib.pyplot as plt
 from scipy import signal
-from bibliotheque_artifact_detection import detect_artifacts, sliding_rms, compute_artifact_features, detect_cross, insert_noise
+from bibliotheque_artifact_detection import detect_artifacts, sliding_rms, compute_artifact_features, detect_cross, insert_noise, merge_intervals
 
 
 def convert_vhdr(run_key, **p):
@@ -27,91 +27,137 @@ def test_convert_vhdr():
 
 
 
-def apply_ica(raw_eeg, exclude, participant, session, n_components, save_figures=False):
+def load_raw_eeg(run_key, p):
     """
-    Compute ICA and exclude ICA components defined in parameters
+    Load raw EEG into mne object : crop to session duration, reref and select eeg channels (in place)
+    This is the signal on which ICA is fitted and applied
+    """
+    import mne
+    raw = get_raw_mne(run_key, participants_label, preload=True) # full load in mne object
+    raw.crop(tmin = 0, tmax = p['session_duration'], include_tmax = False) # crop to 10 mins
+    
+    # REREF (in place, raw is not used anymore after)
+    if not p['reref'] is None: 
+        raw = mne.add_reference_channels(raw, 'Cz',copy = False) # recompute signal of acquisition ref
+        raw,_ = mne.set_eeg_reference(inst=raw, ref_channels=p['reref'], copy=False, ch_type = 'eeg', verbose = False) # reref
+
+    raw_eeg = raw.pick_types(eeg = True) # select eeg data (in place)
+    return raw_eeg
+
+def filter_for_ica(raw_eeg, p):
+    """
+    Return a highpassed copy of raw EEG for better working of ICA
+    """
+    raw_eeg_for_ica_filtered = raw_eeg.copy()
+    raw_eeg_for_ica_filtered = raw_eeg_for_ica_filtered.filter(p['ica_highpass'], None, fir_design='firwin', verbose = 'CRITICAL') # filter with highpass 1 Hz for better working of ICA
+    return raw_eeg_for_ica_filtered
+
+
+def compute_ica_fit(run_key, **p):
+    """
+    Fit ICA on EEG once per run, independently of the components that will be excluded
+    The fitted decomposition (unmixing matrix, PCA state ...) is serialized in the dataset
+    """
+    import mne
+    raw_eeg = load_raw_eeg(run_key, p)
+    raw_eeg_for_ica_filtered = filter_for_ica(raw_eeg, p)
+    del raw_eeg
+
+    ica = mne.preprocessing.ICA(n_components=p['n_components_decomposition'], random_state=p['random_state'], method=p['method'], verbose = 'CRITICAL') # compute ICA
+    ica.fit(raw_eeg_for_ica_filtered, verbose = 'CRITICAL') # run ICA on provided raw data
+    return ica_to_xarray(ica)
+
+def test_compute_ica_fit():
+    run_key = 'P02_baseline'
+    ds = compute_ica_fit(run_key, **ica_fit_params)
+    print(ds)
+    print(xarray_to_ica(ds))
+
+
+def save_ica_figures(ica, raw_eeg_for_ica_filtered, participant, session):
+    """
+    Save figures of ICA sources (time + PSD) and topographies to manually select the EOG components to remove
 
     ----------
     Parameters
     ----------
-    - raw eeg : mne raw object
-    - exclude : list
-        List of integers, each one corresponding the the components to exclude
+    - ica : mne.preprocessing.ICA
+        Fitted ICA
+    - raw_eeg_for_ica_filtered : mne raw object
+        Highpassed EEG on which ICA has been fitted
     - participant : str
         Participant label (to label fig)
     - session : str
         Session label (to label fig)
-    - n_components : int
-        Number of ICA components to subdivide data
-    - save_figures : bool
-        Save figure if True. Default is False
-
-    -------
-    Returns
-    -------
-    - raw_without_filter_but_with_ica : mne object without excluded components
     """
-    import mne
     import ghibtools as gh
-    raw_eeg_for_ica_filtered = raw_eeg.copy()
-    raw_eeg_for_ica_filtered = raw_eeg_for_ica_filtered.filter(1, None, fir_design='firwin', verbose = 'CRITICAL') # filter with highpass 1 Hz for better working of ICA
+    sources_signals = ica.get_sources(raw_eeg_for_ica_filtered).get_data() # get source * time np array
+    duration = 60000 # duration of time vector of figures = 60 secondes at 1000 Hz
+    
+    fig, axs = plt.subplots(nrows = 2, figsize = (15,13), constrained_layout = True)
+    ax = axs[0]
+    ax.set_title(f'{participant} - {session} - 60 seconds sample')
+    ax.set_xlabel('Time points')
+    start = int(300 * srate) # start = during a fast trial after 60 seconds 
+    stop = start + duration
+    for i in range(sources_signals.shape[0]):
+        ax.plot(sources_signals[i,start:stop] + i * -10, linewidth = 0.5, label = f'ICA00{i}') # plot sources during one minute of fast trials
+    ax.legend()
+
+    ax = axs[1]
+    lowest = 0.5
+    rows = []
+    for i in range(sources_signals.shape[0]):
+        f, Pxx = gh.spectre(sources_signals[i], srate, lowest_freq = lowest)
+        slow_power = np.trapz(Pxx[(f > 0.7) & (f < 1.4)]) # compute integral (power) of slow frequency band that could vary according to eye artifacts
+        rows.append([participant, session, i, slow_power])
+        mask = (f > lowest)
+        ax.loglog(f[mask], Pxx[mask], label = i)
+    for j in range(50,550,50):
+        ax.axvline(x=j, color='red', alpha = 0.2)
+        
+    powers = pd.DataFrame(rows, columns = ['participant','session','component', 'slow_power']).sort_values(by = 'slow_power', ascending = False)
+    order_compo = list(powers['component'].values) # sorted list of components according to slow power, may be according to presence of eye movements
+    
+    ax.grid(which = 'minor', alpha = 0.3)
+    ax.set_ylabel('Power [µV**2]')
+    ax.set_xlabel('Freq [Hz]')
+    ax.set_title(f'{participant} - {session} - PSD - slow power order : {order_compo}')
+    ax.legend()
+    plt.savefig(base_folder / 'Figures' / 'ICA' / f'{participant}_{session}_Time_PSD', bbox_inches = 'tight')
+    plt.close()
+    
 
-    random_state = 27 # random constant number
-    method = 'fastica'
-    ica = mne.preprocessing.ICA(n_components=n_components, random_state=random_state, method=method, verbose = 'CRITICAL') # compute ICA
-    ica.fit(raw_eeg_for_ica_filtered, verbose = 'CRITICAL') # run ICA on provided raw data
+    
+    plt.figure()
+    ica.plot_components(title=f'{participant} - {session} - topography components - slow power order : {order_compo}')
+    plt.savefig(base_folder / 'Figures' / 'ICA' / f'{participant}_{session}_Topo')
+    plt.close()
+    
+    plt.close('all')
 
-    if save_figures:
-        sources_signals = ica.get_sources(raw_eeg_for_ica_filtered).get_data() # get source * time np array
-        duration = 60000 # duration of time vector of figures = 60 secondes at 1000 Hz
-        
-        fig, axs = plt.subplots(nrows = 2, figsize = (15,13), constrained_layout = True)
-        ax = axs[0]
-        ax.set_title(f'{participant} - {session} - 60 seconds sample')
-        ax.set_xlabel('Time points')
-        start = int(300 * srate) # start = during a fast trial after 60 seconds 
-        stop = start + duration
-        for i in range(sources_signals.shape[0]):
-            ax.plot(sources_signals[i,start:stop] + i * -10, linewidth = 0.5, label = f'ICA00{i}') # plot sources during one minute of fast trials
-        ax.legend()
-
-        ax = axs[1]
-        lowest = 0.5
-        rows = []
-        for i in range(sources_signals.shape[0]):
-            f, Pxx = gh.spectre(sources_signals[i], srate, lowest_freq = lowest)
-            slow_power = np.trapz(Pxx[(f > 0.7) & (f < 1.4)]) # compute integral (power) of slow frequency band that could vary according to eye artifacts
-            rows.append([participant, session, i, slow_power])
-            mask = (f > lowest)
-            ax.loglog(f[mask], Pxx[mask], label = i)
-        for j in range(50,550,50):
-            ax.axvline(x=j, color='red', alpha = 0.2)
-            
-        powers = pd.DataFrame(rows, columns = ['participant','session','component', 'slow_power']).sort_values(by = 'slow_power', ascending = False)
-        order_compo = list(powers['component'].values) # sorted list of components according to slow power, may be according to presence of eye movements
-        
-        ax.grid(which = 'minor', alpha = 0.3)
-        ax.set_ylabel('Power [µV**2]')
-        ax.set_xlabel('Freq [Hz]')
-        ax.set_title(f'{participant} - {session} - PSD - slow power order : {order_compo}')
-        ax.legend()
-        plt.savefig(base_folder / 'Figures' / 'ICA' / f'{participant}_{session}_Time_PSD', bbox_inches = 'tight')
-        plt.close()
-        
 
-        
-        plt.figure()
-        ica.plot_components(title=f'{participant} - {session} - topography components - slow power order : {order_compo}')
-        plt.savefig(base_folder / 'Figures' / 'ICA' / f'{participant}_{session}_Topo')
-        plt.close()
-        
-        plt.close('all')
-        
-            
-            
+def apply_ica(raw_eeg, ica, exclude, copy=True):
+    """
+    Exclude ICA components defined in parameters with an already fitted ICA
 
+    ----------
+    Parameters
+    ----------
+    - raw eeg : mne raw object
+    - ica : mne.preprocessing.ICA
+        Fitted ICA (see ica_fit_job)
+    - exclude : list
+        List of integers, each one corresponding the the components to exclude
+    - copy : bool
+        Apply ICA on a copy of raw_eeg if True, else in place to save memory. Default is True
 
-    raw_without_filter_but_with_ica = raw_eeg.copy()
+    -------
+    Returns
+    -------
+    - raw_without_filter_but_with_ica : mne object without excluded components
+    """
+    raw_without_filter_but_with_ica = raw_eeg.copy() if copy else raw_eeg
     ica.apply(raw_without_filter_but_with_ica, exclude = exclude, verbose = 'CRITICAL') # applique sur le raw originel (pas filtré) ce qui a été calculé sur le raw_ica filtré 1 Hz lowcut
 
     return raw_without_filter_but_with_ica
@@ -124,11 +170,12 @@ def compute_ica_figure(run_key, **p):
     """
     participant, session = run_key.split('_')
 
-    raw = get_raw_mne(run_key, participants_label, preload=True) # load data into raw mne object
-    raw_eeg = raw.copy()
-    raw_eeg = raw_eeg.pick_types(eeg = True) # select just eeg data
+    ica = xarray_to_ica(ica_fit_job.get(run_key)) # cached fitted ICA
+    raw_eeg = load_raw_eeg(run_key, p['ica_fit_params']) # same signal than the one used for fitting
+    raw_eeg_for_ica_filtered = filter_for_ica(raw_eeg, p['ica_fit_params'])
+    del raw_eeg
 
-    apply_ica(raw_eeg, [0], participant, session, p['n_components_decomposition'], save_figures=True) # save_figures = True to save
+    save_ica_figures(ica, raw_eeg_for_ica_filtered, participant, session)
 
     return None
 
@@ -153,36 +200,38 @@ def compute_preproc(run_key, **p):
 
     participant, session = run_key.split('_')
 
-    # LOAD
-    raw = get_raw_mne(run_key, participants_label, preload=True) # full load in mne object
-    raw.crop(tmin = 0, tmax = p['session_duration'], include_tmax = False) # crop to 10 mins
-    
-    # REREF
-    if not p['reref'] is None: 
-        raw = mne.add_reference_channels(raw, 'Cz',copy = True) # recompute signal of acquisition ref
-        raw,_ = mne.set_eeg_reference(inst=raw, ref_channels=p['reref'], copy=True, ch_type = 'eeg', verbose = False) # reref
+    # LOAD + REREF
+    raw_eeg = load_raw_eeg(run_key, p)
 
-    # NOTCH
-    raw_notched = raw.copy()
-    raw_notched.notch_filter(p['notch_freqs'], verbose = False)
+    # NOTCH : notched signal was never used after (ICA and filtering are done on the non notched signal) so it is not computed anymore
+    # raw_notched = raw.copy()
+    # raw_notched.notch_filter(p['notch_freqs'], verbose = False)
 
     # ICA
+    ica = xarray_to_ica(ica_fit_job.get(run_key)) # fitted once by ica_fit_job, only the exclusion is done here (figures are saved by ica_figure_job)
     ica_excluded_component = p['ica_excluded_component']
     exclude = ica_excluded_component[participant][session]
-    raw_eeg = raw.copy()
-    raw_eeg = raw_eeg.pick_types(eeg = True) # select eeg data
-    raw_clean_from_eog = apply_ica(raw_eeg, exclude, participant, session, p['n_components_decomposition'], save_figures= p['save_ica_fig']) # just apply ICA by exluding EOG components as explored in pre-saved figures
+    raw_clean_from_eog = apply_ica(raw_eeg, ica, exclude, copy=False) # just apply ICA by exluding EOG components as explored in pre-saved figures
     
     # DETREND AND FILTERING
     data = raw_clean_from_eog.get_data() # mne object to numpy
-    data_detrended = signal.detrend(data, axis = 1) # detrend
-    data_filtered = gh.iirfilt(data_detrended, srate, lowcut = p['lowcut'], highcut= p['highcut'], order = p['order'] , axis = 1) # filtering
+    chan_names = raw_clean_from_eog.ch_names
+    del raw_eeg, raw_clean_from_eog
+    if preproc_chunk_duration is None:
+        data_detrended = signal.detrend(data, axis = 1) # detrend
+        data_filtered = gh.iirfilt(data_detrended, srate, lowcut = p['lowcut'], highcut= p['highcut'], order = p['order'] , axis = 1) # filtering
+    else:
+        # in place and chunk by chunk : no full size temporary copy
+        chunk_size = int(preproc_chunk_duration * srate)
+        data_filtered = chunked_detrend(data, chunk_size) # detrend
+        sos = signal.iirfilter(p['order'], [p['lowcut'], p['highcut']], btype = 'bandpass', ftype = p['ftype'], fs = srate, output = 'sos')
+        data_filtered = chunked_sosfiltfilt(sos, data_filtered, chunk_size) # filtering (zero phase, filter state carried between chunks)
     
     # OUTPUT in XARRAY DATASET
-    times = np.arange(data.shape[1]) / srate
+    times = np.arange(data_filtered.shape[1]) / srate
     ds = xr.Dataset()
     ds['eeg_clean'] = xr.DataArray(data = data_filtered, dims = ['chan','time'],
-                                   coords = {'chan':raw_clean_from_eog.ch_names, 'time':times}, 
+                                   coords = {'chan':chan_names, 'time':times}, 
                                    attrs = {'srate':srate})
 
     return ds
@@ -193,29 +242,103 @@ def test_compute_preproc():
     print(ds)
     
     
-def detect_movement_artifacts(run_key, **p):
+def compute_artifact_rms(eeg, srate, p):
     """
-    Detect movement artifacts based on sharp cooccuring burst of gamma power on all channels
+    Smooth amplitude (sliding RMS) of EEG filtered on artifact frequency band, all channels at once
+    """
+    import ghibtools as gh
+    eeg_filt = gh.iirfilt(eeg, srate, p['lf'], p['hf'], ftype = 'bessel', order = 2, axis = 1) # filter on artifact frequency band
+    t, rms = sliding_rms(eeg_filt, sf=srate, window = p['window_size'], step = p['step']) # get smooth amplitude of filtered sig of all channels at once
+    return rms
+
+def detect_cooccuring_artifacts(rms, srate, n_deviations, n_chan_artifacted):
+    """
+    Detect artifacts when at least n_chan_artifacted channels have their RMS above median + n_deviations * MAD at the same time
+    """
+    import ghibtools as gh
+    masks = np.zeros(rms.shape)
+    for i in range(rms.shape[0]): # loop on channels
+        pos, dev = gh.med_mad(rms[i,:]) # signal statistics
+        detect_threshold = pos + n_deviations * dev # compute threshold
+        masks[i,:] = rms[i,:] > detect_threshold # True value when artifact
+    
+    compress_chans = masks.sum(axis = 0) # sum of True on chan axis
+    inds = detect_cross(compress_chans, n_chan_artifacted+0.5) # detect inds when at least n_chan_artifacted are artifacted at the same time
+    if inds is None:
+        inds = pd.DataFrame({'rises':np.array([], dtype='int64'), 'decays':np.array([], dtype='int64')})
+    artifacts = compute_artifact_features(inds, srate) # compute dataframe that summarizes artifacts temporality
+    return artifacts
+
+def detect_artifacts_by_channel(rms, chans, srate, n_deviations):
+    """
+    Detect artifacts channel by channel when RMS is above median + n_deviations * MAD
     """
     import ghibtools as gh
+    artifacts = [] # initialise a list of dataframes that will bo concatenated
+    for i, chan in enumerate(chans): # loop on channels
+        pos, dev = gh.med_mad(rms[i,:]) # signal statistics
+        detect_threshold = pos + n_deviations * dev # compute threshold
+        cross = detect_cross((rms[i,:] > detect_threshold).astype(int), 0.5) # 1 value when artifact and detect starts and stop inds of artifact zones and store into a dataframe
+        if not cross is None:
+            cross['chan'] = chan
+            artifacts.append(cross)
+    
+    if len(artifacts) > 0:
+        artifacts = pd.concat(artifacts, axis=0) # concat artifact dataframes
+    else:
+        artifacts = pd.DataFrame({'rises':np.array([], dtype='int64'), 'decays':np.array([], dtype='int64'), 'chan':np.array([], dtype='str')})
+    artifacts['start_t'] = artifacts['rises'] / srate # transform inds in times
+    artifacts['stop_t'] = artifacts['decays'] / srate # transform inds in times
+    artifacts = artifacts.rename(columns = {'rises':'start_ind','decays':'stop_ind'}) # rename colnames
+    return artifacts
+
+
+def detect_all_movement_artifacts(run_key, **p):
+    """
+    Detect movement artifacts co-occuring on all channels and channel by channel in one pass :
+    EEG is loaded, filtered and its sliding RMS computed once for both detections
+    """
+    pa = p['artifact_params']
+    pc = p['artifact_by_chan_params']
+    for k in ['preproc_params', 'window_size', 'step', 'lf', 'hf']:
+        assert pa[k] == pc[k], f'artifact_params and artifact_by_chan_params must share {k}'
     
     da = preproc_job.get(run_key)['eeg_clean'] # load
     srate = da.attrs['srate']
     
-    eeg_filt = gh.iirfilt(da.values, srate, p['lf'], p['hf'], ftype = 'bessel', order = 2, axis = 1) # filter on artifact frequency band
-    masks = eeg_filt.copy()
-    
-    for i in range(eeg_filt.shape[0]): # loop on channels
-        sig_chan_filtered = eeg_filt[i,:]
-        t, rms_chan = sliding_rms(sig_chan_filtered, sf=srate, window = p['window_size'], step = p['step']) # get smooth amplitude of filtered sig
-        pos, dev = gh.med_mad(rms_chan) # signal statistics
-        detect_threshold = pos + p['n_deviations'] * dev # compute threshold
-        masks[i,:] = rms_chan > detect_threshold # True value when artifact
+    rms = compute_artifact_rms(da.values, srate, pa)
     
-    compress_chans = masks.sum(axis = 0) # sum of True on chan axis
-    inds = detect_cross(compress_chans, p['n_chan_artifacted']+0.5) # detect inds when at least p['n_chan_artifact'] are artifacted at the same time
-    artifacts = compute_artifact_features(inds, srate) # compute dataframe that summarizes artifacts temporality
+    artifacts = detect_cooccuring_artifacts(rms, srate, pa['n_deviations'], pa['n_chan_artifacted'])
+    artifacts_by_chan = detect_artifacts_by_channel(rms, da.coords['chan'].values, srate, pc['n_deviations'])
     
+    # both tables in one dataset, variables prefixed by table name
+    ds = xr.Dataset()
+    for name, df in [('artifact', artifacts), ('artifact_by_chan', artifacts_by_chan)]:
+        df = df.reset_index(drop = True)
+        for col in df.columns:
+            ds[f'{name}_{col}'] = xr.DataArray(df[col].values, dims = [name])
+    return ds
+
+def get_artifact_table(ds, name):
+    """
+    Extract one of the artifact tables (artifact or artifact_by_chan) of detect_all_movement_artifacts() output
+    """
+    prefix = f'{name}_'
+    cols = {var[len(prefix):]: ds[var].values for var in ds.data_vars if ds[var].dims == (name,)}
+    return pd.DataFrame(cols)
+
+def test_detect_all_movement_artifacts():
+    run_key = 'P02_baseline'
+    ds = detect_all_movement_artifacts(run_key, **artifact_detection_params)
+    print(get_artifact_table(ds, 'artifact'))
+    print(get_artifact_table(ds, 'artifact_by_chan'))
+
+
+def detect_movement_artifacts(run_key, **p):
+    """
+    Detect movement artifacts based on sharp cooccuring burst of gamma power on all channels
+    """
+    artifacts = get_artifact_table(artifact_detection_job.get(run_key), 'artifact')
     return xr.Dataset(artifacts)
 
 def test_detect_movement_artifacts():
@@ -231,29 +354,7 @@ def detect_movement_artifacts_by_channel(run_key, **p):
     """
     Detect movement artifacts based on sharp burst of gamma power channel by channel
     """
-    import ghibtools as gh
-    
-    da = preproc_job.get(run_key)['eeg_clean'] # load
-    srate = da.attrs['srate']
-    
-    eeg_filt = gh.iirfilt(da.values, srate, p['lf'], p['hf'], ftype = 'bessel', order = 2, axis = 1) # filter on artifact frequency band
-    
-    artifacts = [] # initialise a list of dataframes that will bo concatenated
-    for i in range(eeg_filt.shape[0]): # loop on channels
-        chan = da.coords['chan'].values[i]
-        sig_chan_filtered = eeg_filt[i,:]
-        t, rms_chan = sliding_rms(sig_chan_filtered, sf=srate, window = p['window_size'], step = p['step']) # get smooth amplitude of filtered sig
-        pos, dev = gh.med_mad(rms_chan) # signal statistics
-        detect_threshold = pos + p['n_deviations'] * dev # compute threshold
-        cross = detect_cross((rms_chan > detect_threshold).astype(int), 0.5) # 1 value when artifact and detect starts and stop inds of artifact zones and store into a dataframe
-        if not cross is None:
-            cross['chan'] = chan
-            artifacts.append(cross)
-    
-    artifacts = pd.concat(artifacts, axis=0) # concat artifact dataframes
-    artifacts['start_t'] = artifacts['rises'] / srate # transform inds in times
-    artifacts['stop_t'] = artifacts['decays'] / srate # transform inds in times
-    artifacts = artifacts.rename(columns = {'rises':'start_ind','decays':'stop_ind'}) # rename colnames
+    artifacts = get_artifact_table(artifact_detection_job.get(run_key), 'artifact_by_chan')
     return xr.Dataset(artifacts) # dataframe to xarray dataset
 
 
@@ -303,7 +404,8 @@ def count_artifact(sub_key, **p):
     for ses in session_keys:
         run_key = f'{sub_key}_{ses}'
         artifacts = artifact_job.get(run_key).to_dataframe()
-        n_secs_artifacted = artifacts['duration'].sum()
+        starts, stops = merge_intervals(artifacts['start_t'].values, artifacts['stop_t'].values) # union of artifacts (time artifacted counted once)
+        n_secs_artifacted = np.sum(stops - starts)
         prop_secs_artifacted = n_secs_artifacted / p['session_duration']
         row = [sub_key, ses , n_secs_artifacted,prop_secs_artifacted]
         rows.append(row)
@@ -322,7 +424,9 @@ def test_count_artifact():
     
 def compute_all():
     # jobtools.compute_job_list(preproc_job, run_keys, force_recompute=False, engine='joblib', n_jobs = 6)
+    # jobtools.compute_job_list(ica_fit_job, run_keys, force_recompute=False, engine='joblib', n_jobs = 6)
     # jobtools.compute_job_list(ica_figure_job, run_keys, force_recompute=False, engine='loop')
+    # jobtools.compute_job_list(artifact_detection_job, run_keys, force_recompute=False, engine='joblib', n_jobs = 6)
     # jobtools.compute_job_list(artifact_job, run_keys, force_recompute=False, engine='joblib', n_jobs = 6)
     # jobtools.compute_job_list(artifact_by_chan_job, run_keys, force_recompute=False, engine='joblib', n_jobs = 6)
     jobtools.compute_job_list(convert_vhdr_job, run_keys, force_recompute=False, engine='loop')
@@ -331,33 +435,50 @@ def compute_all():
     # jobtools.compute_job_list(count_artifact_job, subject_keys, force_recompute=False, engine='joblib', n_jobs = 6)
 
 
-convert_vhdr_job = jobtools.Job(precomputedir, 'convert_vhdr',convert_vhdr_params, convert_vhdr)
+convert_vhdr_job = jobtools.Job(precomputedir, 'convert_vhdr',convert_vhdr_params, convert_vhdr,
+                                storage=jobtools.ZarrStorage(chunks={'chan':1, 'time':100000})) # chunked by chan : bio jobs read only their own trace (ECG, RespiNasale, GSR)
 jobtools.register_job(convert_vhdr_job)
 
-ica_figure_job = jobtools.Job(precomputedir, 'ica_figure', ica_figure_params, compute_ica_figure)
+ica_fit_job = jobtools.Job(precomputedir, 'ica_fit', ica_fit_params, compute_ica_fit)
+jobtools.register_job(ica_fit_job)
+
+ica_figure_job = jobtools.Job(precomputedir, 'ica_figure', ica_figure_params, compute_ica_figure,
+                              depends_on=[(ica_fit_job, None)])
 jobtools.register_job(ica_figure_job)
 
-preproc_job = jobtools.Job(precomputedir, 'preproc',preproc_params, compute_preproc)
+preproc_job = jobtools.Job(precomputedir, 'preproc',preproc_params, compute_preproc,
+                           depends_on=[(ica_fit_job, None)])
 jobtools.register_job(preproc_job)
 
-artifact_job = jobtools.Job(precomputedir, 'movements_artifacts', artifact_params, detect_movement_artifacts)
+artifact_detection_job = jobtools.Job(precomputedir, 'movements_artifacts_detection', artifact_detection_params, detect_all_movement_artifacts,
+                                      depends_on=[(preproc_job, None)])
+jobtools.register_job(artifact_detection_job)
+
+artifact_job = jobtools.Job(precomputedir, 'movements_artifacts', artifact_params, detect_movement_artifacts,
+                            depends_on=[(artifact_detection_job, None)])
 jobtools.register_job(artifact_job)
 
-artifact_by_chan_job = jobtools.Job(precomputedir, 'movements_artifacts_by_chan', artifact_by_chan_params, detect_movement_artifacts_by_channel)
+artifact_by_chan_job = jobtools.Job(precomputedir, 'movements_artifacts_by_chan', artifact_by_chan_params, detect_movement_artifacts_by_channel,
+                                    depends_on=[(artifact_detection_job, None)])
 jobtools.register_job(artifact_by_chan_job)
 
-eeg_interp_artifact_job = jobtools.Job(precomputedir, 'eeg_interp', interp_artifact_params, interp_artifact)
+eeg_interp_artifact_job = jobtools.Job(precomputedir, 'eeg_interp', interp_artifact_params, interp_artifact,
+                                       depends_on=[(preproc_job, None), (artifact_by_chan_job, None)],
+                                       storage=jobtools.ZarrStorage(chunks={'chan':1, 'time':100000})) # chunked by chan : power job read only one chan
 jobtools.register_job(eeg_interp_artifact_job)
 
-count_artifact_job = jobtools.Job(precomputedir, 'count_artifacts', count_artifact_params, count_artifact)
+count_artifact_job = jobtools.Job(precomputedir, 'count_artifacts', count_artifact_params, count_artifact,
+                                  depends_on=[(artifact_job, lambda sub_key: [(f'{sub_key}_{ses}',) for ses in session_keys])])
 jobtools.register_job(count_artifact_job)
 
 
 
 if __name__ == '__main__':
     # test_convert_vhdr()
+    # test_compute_ica_fit()
     # test_compute_ica_figure()
     # test_compute_preproc()
+    # test_detect_all_movement_artifacts()
     # test_detect_movement_artifacts()
     # test_detect_movement_artifacts_by_channel()
     # test_interp_artifact()